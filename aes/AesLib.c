@@ -184,40 +184,64 @@ static inline void Encrypt (unsigned char State[4][MAXBC])
   	((v4u *) State)[3] = ((v4u *) State)[3] ^ ((v4u *) RoundKey[ROUNDS])[3];
 }
 
-void AesCtrCipher(
-		unsigned char *In,
-		unsigned char *Out,
+void AesCtrInit(
+		AesCtrContext *Ctx,
 		unsigned char Key[4][MAXBC],
 		unsigned char IV[2][MAXBC],
-		int Len,
 		int Reset)
 
+{
+	if (Reset) KeyExpansion(Key);
+
+	((unsigned int *) Ctx->State)[0] = ((unsigned int *) IV)[0];
+	((unsigned int *) Ctx->State)[1] = ((unsigned int *) IV)[1];
+	((unsigned int *) Ctx->State)[2] = 0;
+	Ctx->Counter = 0;
+}
+
+/* The counter block is encrypted in place, so each block of keystream depends on the previous one.
+   The context carries it from one call to the next, Len must thus be a multiple of 16 for all calls except the last one. */
+void AesCtrStream(
+		AesCtrContext *Ctx,
+		unsigned char *In,
+		unsigned char *Out,
+		int Len)
+
 {
 	int i, j;
 	unsigned char Buff[16];
-	unsigned char State[4][4];
-	int Counter = 0;
 	v4u *Vo = (v4u *) Out;
 	v4u *Vi = (v4u *) In;
 	v4u *VBuff = (v4u *) Buff;
 
-	if (Reset) KeyExpansion(Key);
-
-	((unsigned int *) State)[0] = ((unsigned int *) IV)[0];
-	((unsigned int *) State)[1] = ((unsigned int *) IV)[1];
-	((unsigned int *) State)[2] = 0;
-
 	for (i=0; i<Len/16; i++) {
-		((unsigned int *) State)[3] = Counter++;
-		Encrypt(State);
-		for (j=0; j<4; j++) *Vo++ = *Vi++ ^ ((v4u *) State)[j];
+		((unsigned int *) Ctx->State)[3] = Ctx->Counter++;
+		Encrypt(Ctx->State);
+		for (j=0; j<4; j++) *Vo++ = *Vi++ ^ ((v4u *) Ctx->State)[j];
+	}
+	if (Len%16) {
+		((unsigned int *) Ctx->State)[3] = Ctx->Counter++;
+		Encrypt(Ctx->State);
+		VBuff[0] = (v4u) {0, 0, 0, 0}; VBuff[1] = (v4u) {0, 0, 0, 0}; VBuff[2] = (v4u) {0, 0, 0, 0}; VBuff[3] = (v4u) {0, 0, 0, 0};
+		for (i=0; i<(Len%16); i++) Buff[i] = In[(Len&(~0x0F)) + i];
+		for (i=0; i<4; i++) VBuff[i] = VBuff[i] ^ ((v4u *) Ctx->State)[i];
+		for (j=0, i=Len & (~0x0F); i<Len; i++, j++) Out[i] = Buff[j];
 	}
-	((unsigned int *) State)[3] = Counter++;
-	Encrypt(State);
-	VBuff[0] = (v4u) {0, 0, 0, 0}; VBuff[1] = (v4u) {0, 0, 0, 0}; VBuff[2] = (v4u) {0, 0, 0, 0}; VBuff[3] = (v4u) {0, 0, 0, 0};
-	for (i=0; i<(Len%16); i++) Buff[i] = In[(Len&(~0x0F)) + i];
-	for (i=0; i<4; i++) VBuff[i] = VBuff[i] ^ ((v4u *) State)[i];
-	for (j=0, i=Len & (~0x0F); i<Len; i++, j++) Out[i] = Buff[j];
+}
+
+void AesCtrCipher(
+		unsigned char *In,
+		unsigned char *Out,
+		unsigned char Key[4][MAXBC],
+		unsigned char IV[2][MAXBC],
+		int Len,
+		int Reset)
+
+{
+	AesCtrContext Ctx;
+
+	AesCtrInit(&Ctx, Key, IV, Reset);
+	AesCtrStream(&Ctx, In, Out, Len);
 
 //printf("Constants: %d, Work: %d\n", sizeof(mul2)+sizeof(mul3)+sizeof(S)+sizeof(RC), sizeof(RoundKey));
 }
@@ -3,7 +3,22 @@
 
 #define MAXBC         (4)
 
+typedef struct {
+	unsigned char State[4][MAXBC];
+	unsigned int Counter;
+} AesCtrContext;
+
 extern void AesBuildLUT();
+extern void AesCtrInit(
+		AesCtrContext *Ctx,
+		unsigned char Key[4][MAXBC],
+		unsigned char IV[2][MAXBC],
+		int Reset);
+extern void AesCtrStream(
+		AesCtrContext *Ctx,
+		unsigned char *In,
+		unsigned char *Out,
+		int Len);
 extern void AesCtrCipher(
 		unsigned char *In,
 		unsigned char *Out,
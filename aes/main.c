@@ -51,22 +51,32 @@ int main(int argc, char *argv[])
 	((unsigned int *) IV)[0] = strtol(&argv[2][8], NULL, 16); argv[2][8] = 0;
 	((unsigned int *) IV)[1] = strtol(&argv[2][0], NULL, 16);
 
-	int bufferSize = 16*1024*1024;
+	/* The input is ciphered chunk by chunk so that its size is not limited, the chunk size must be a multiple
+	   of the AES block size so that the counter can continue on the next chunk */
+	int bufferSize = 1024*1024;
 	unsigned char *buffer = malloc(bufferSize);
-	bufferSize = fread(buffer, 1, bufferSize, stdin);
+	if (buffer == NULL) return -1;
 
 	//printf("Initialization Vector: %s\n", HexImage((unsigned char *) IV, 8));
 	//printf("AES128 Key           : %s\n", HexImage((unsigned char *) Key, 16));
 
 	AesBuildLUT();
 
+	AesCtrContext Ctx;
+	AesCtrInit(&Ctx, Key, IV, 1);
 
+	while (1) {
+		int size = fread(buffer, 1, bufferSize, stdin);
+		if (size == 0) break;
 
+		AesCtrStream(&Ctx, buffer, buffer, size);
 
-	AesCtrCipher(buffer, buffer, Key, IV, bufferSize, 1);
+		if (fwrite(buffer, 1, size, stdout) != size) return -1;
 
-	fwrite(buffer, 1, bufferSize, stdout);
+		if (size != bufferSize) break;
+	}
 
+	if (ferror(stdin)) return -1;
 
     //DumpMessage("Ciphered", buffer, bufferSize, 0);
 	//AesCtrCipher(buffer, buffer, Key, IV, bufferSize, 0);
@@ -5,6 +5,9 @@ from plp_platform import *
 import os
 import os.path
 import time
+import hashlib
+import json
+import tempfile
 import runner.plp_flash_stimuli as plp_flash_stimuli
 
 def execCmd(cmd):
@@ -32,8 +35,14 @@ class Runner(Platform):
         
         parser.add_argument("--devices", dest="devices", default=[], action="append",
                             help='specify platform devices')
+        parser.add_argument("--flash-full", dest="flashFull", action="store_true", default=False,
+                            help='always erase and write the whole flash. By default, only the sectors which differ from the image last written by the runner to the same board are written. ' +
+                            'The board is identified by the serial number of its FTDI cable, and the whole flash is written if it can not be identified. ' +
+                            'Use this option if the flash may have been modified by something else')
         
         [args, otherArgs] = parser.parse_known_args()
+
+        self.flash_info = None
    
         self.addCommand('run', 'Run execution')
         self.addCommand('prepare', 'Prepare binary')
@@ -68,23 +77,108 @@ class Runner(Platform):
             aes_key = self.get_json().get_child_str('**/efuse/aes_key')
             aes_iv = self.get_json().get_child_str('**/efuse/aes_iv')
 
-            if plp_flash_stimuli.genFlashImage(
+            self.flash_info = plp_flash_stimuli.genFlashImage(
                 raw_stim=self.get_flash_preload_file(),
                 bootBinary=self.get_json().get('**/runner/binaries').get_elem(0).get(),
                 comps=comps,
                 verbose=self.get_json().get('**/runner/verbose').get(),
                 archi=self.get_json().get('**/pulp_chip_family').get(),
                 flashType=self.get_json().get('**/runner/flash_type').get(),
-                encrypt=encrypted, aesKey=aes_key, aesIv=aes_iv):
-                return -1
+                encrypt=encrypted, aesKey=aes_key, aesIv=aes_iv)
 
             if self.flash():
                 return -1
 
         return 0
 
+    def get_flash_manifest_file(self, board):
+        # The manifest describes the image last written to the flash of the
+        # board, it is shared by all the tests using it
+        path = os.environ.get('PLP_FLASH_MANIFEST_DIR')
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.plp_flash')
+        name = '_'.join([str(board[key]) for key in sorted(board.keys())])
+        name = ''.join([c if c.isalnum() or c in '-.' else '_' for c in name])
+        return os.path.join(path, '%s.json' % name)
+
+    def get_board_id(self):
+        # Identity of the physical board, made of the serial number and USB
+        # location of its FTDI cable. If the cable serial is specified in the
+        # configuration, the matching cable is used, otherwise there must be
+        # only one FTDI cable connected. None is returned if the board can not
+        # be identified.
+        serial = self.get_json().get_child_str('**/debug_bridge/cable/serial')
+        devices_path = '/sys/bus/usb/devices'
+
+        boards = []
+        try:
+            devices = os.listdir(devices_path)
+        except OSError:
+            return None
+
+        for device in devices:
+            path = os.path.join(devices_path, device)
+            try:
+                with open(os.path.join(path, 'idVendor'), 'r') as file:
+                    if file.read().strip() != '0403':
+                        continue
+                with open(os.path.join(path, 'serial'), 'r') as file:
+                    device_serial = file.read().strip()
+            except IOError:
+                continue
+
+            if serial is None or serial == device_serial:
+                boards.append('%s@%s' % (device_serial, device))
+
+        if len(boards) != 1:
+            return None
+
+        return boards[0]
+
+    def flash_all(self, bridge_opt, flash_file):
+        if execCmd('plpbridge %s flash_erase_chip --flasher-init' % bridge_opt):
+            return -1
+        if execCmd('plpbridge %s flash_write --addr=0 --file=%s --flasher-init' % (bridge_opt, flash_file)):
+            return -1
+        return 0
+
+    def flash_blocks(self, bridge_opt, flash_file, image, blocks, old_blocks, block_size):
+        # Rewrite only the blocks which differ from the last written image,
+        # including the ones of the previous image which are now beyond
+        # the end of the new image, and which are just erased
+        dirty = []
+        for index in range(0, max(len(blocks), len(old_blocks))):
+            if index >= len(blocks) or index >= len(old_blocks) or blocks[index] != old_blocks[index]:
+                if len(dirty) != 0 and dirty[-1][1] == index:
+                    dirty[-1][1] = index + 1
+                else:
+                    dirty.append([index, index + 1])
+
+        print ('Updating %d flash sectors (image: %d sectors)' % (sum([last - first for first, last in dirty]), len(blocks)))
+
+        for first, last in dirty:
+            addr = first * block_size
+            size = (last - first) * block_size
+            if execCmd('plpbridge %s flash_erase --addr=0x%x --size=0x%x --flasher-init' % (bridge_opt, addr, size)):
+                return -1
+
+            data = image[addr:addr+size]
+            if len(data) != 0:
+                fd, part_file = tempfile.mkstemp(prefix=os.path.basename(flash_file) + '.', dir=os.path.dirname(flash_file))
+                try:
+                    with os.fdopen(fd, 'wb') as file:
+                        file.write(data)
+                    if execCmd('plpbridge %s flash_write --addr=0x%x --file=%s --flasher-init' % (bridge_opt, addr, part_file)):
+                        return -1
+                finally:
+                    os.remove(part_file)
+
+        return 0
+
     def flash(self):
         chip_name = self.get_json().get_child_str('**/chip/name')
+        cable = self.get_json().get_child_str('**/debug_bridge/cable/type')
+        flash_type = self.get_json().get_child_str('**/runner/flash_type')
 
         config = self.config.getOption('config_file')
         if config is not None:
@@ -92,12 +186,66 @@ class Runner(Platform):
         else:
             config = '--config %s' % self.config.getOption('config_name')
 
-        bridge_opt = '%s --cable %s' % (config, self.get_json().get_child_str('**/debug_bridge/cable/type'))
+        bridge_opt = '%s --cable %s' % (config, cable)
 
-        if execCmd('plpbridge %s flash_erase_chip --flasher-init' % bridge_opt):
-            return -1
-        if execCmd('plpbridge %s flash_write --addr=0 --file=%s --flasher-init' % (bridge_opt, self.get_flash_preload_file())):
-            return -1
+        flash_file = self.get_flash_preload_file()
+        if self.flash_info is not None:
+            block_size = self.flash_info.blockSize
+        else:
+            block_size = 4096
+
+        with open(flash_file, 'rb') as file:
+            image = file.read()
+
+        blocks = [hashlib.sha1(image[index:index+block_size]).hexdigest() for index in range(0, len(image), block_size)]
+
+        # The flash content can only be known from a previous run if the
+        # physical board can be identified, otherwise it is always fully
+        # erased
+        manifest = None
+        manifest_file = None
+        flash_full = self.config.getOption('flashFull')
+        board_id = self.get_board_id()
+        if board_id is None:
+            print ('Board can not be identified, writing the whole flash')
+        else:
+            board = {'board': board_id, 'chip': chip_name, 'cable': cable, 'config': config, 'flash_type': flash_type, 'block_size': block_size}
+            manifest_file = self.get_flash_manifest_file(board)
+
+            # Only SPI flashes have sectors as small as image blocks, other
+            # flashes are always fully erased, as well as when this is
+            # requested. The manifest is still updated in this case.
+            if flash_type in [None, 'spi'] and not flash_full:
+                try:
+                    with open(manifest_file, 'r') as file:
+                        manifest = json.load(file)
+                    if manifest.get('board') != board:
+                        manifest = None
+                except (IOError, ValueError):
+                    manifest = None
+
+            # Remove the manifest while the flash is being modified so that an
+            # interrupted run leads to a full erase next time
+            if os.path.exists(manifest_file):
+                os.remove(manifest_file)
+
+        if manifest is not None:
+            if self.flash_blocks(bridge_opt, flash_file, image, blocks, manifest['blocks'], block_size):
+                print ('Partial flash update failed, erasing and writing the whole flash')
+                manifest = None
+
+        if manifest is None:
+            if self.flash_all(bridge_opt, flash_file):
+                return -1
+
+        if manifest_file is not None:
+            try:
+                os.makedirs(os.path.dirname(manifest_file))
+            except OSError:
+                pass
+
+            with open(manifest_file, 'w') as file:
+                json.dump({'board': board, 'blocks': blocks}, file)
 
         return 0
 
@@ -23,6 +23,7 @@
 
 import os.path
 import ast
+import runner.config_cache as config_cache
 
 class Platform(object):
 
@@ -30,7 +31,9 @@ class Platform(object):
         self.commands = []
         self.modules = []
         self.config = config
-        self.js_config = js_config
+        # Lookups in the configuration are memoized as runners do the same
+        # ones many times, they are only counted in verbose mode
+        self.js_config = config_cache.CachedConfig(js_config, stats=js_config.get_child_bool('**/runner/verbose'))
 
     def get_json(self):
         return self.js_config
@@ -60,9 +63,17 @@ class Platform(object):
         else:
             commands = self.config.getArgs().command
             if len(commands) == 0: commands = ['run']
+            retval = 0
             for command in commands:
-                if self.execCommand(command) != 0: return 1
-            return 0
+                if self.execCommand(command) != 0:
+                    retval = 1
+                    break
+            self.dumpConfigStats()
+            return retval
+
+    def dumpConfigStats(self):
+        if self.js_config.get_child_bool('**/runner/verbose'):
+            self.js_config.dump_stats()
 
 
     def execCommand(self, cmd):
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import ctypes
+import os
+import struct
+
+
+# AES-128-CTR encryption producing the same output as the aes_encode tool,
+# without spawning it.
+#
+# Buffers are encrypted by AesLib (aes/AesLib.c), which is built as a shared
+# library installed next to this file, and called through ctypes. If it is
+# not available, the Python implementation below, which is about 100 times
+# slower, is used instead.
+#
+# aes_encode has a few specificities compared to a textbook AES-CTR:
+#   - The key and IV strings are parsed as 32-bit words starting from the
+#     end of the string, so their bytes are in reverse order.
+#   - The AES state is stored row by row instead of column by column, so
+#     the key, the counter block and the resulting keystream block are all
+#     transposed compared to the standard AES.
+#   - The counter block is encrypted in place, so only its last 32-bit word
+#     is replaced by the little-endian block counter for the next block and
+#     the first 12 bytes are the ones of the previous encrypted block. The
+#     first block is made of the 8 bytes of IV, 4 bytes at 0 and a counter
+#     at 0. The keystream must thus be computed sequentially.
+# The standard AES below is thus used with transposed inputs and outputs.
+
+
+# Size of the keystream kept by each Python engine
+KEYSTREAM_CACHE_SIZE = 4096
+
+
+
+def _xtime(value):
+  value <<= 1
+  if value & 0x100:
+    value ^= 0x11b
+  return value
+
+
+def _gen_tables():
+
+  sbox = [0] * 256
+
+  # Walk the multiplicative group with p * q == 1 to compute the inverses
+  p = q = 1
+  while True:
+    p = p ^ _xtime(p) & 0xff
+    q ^= q << 1
+    q ^= q << 2
+    q ^= q << 4
+    q &= 0xff
+    if q & 0x80:
+      q ^= 0x09
+    rotl = lambda x, shift: ((x << shift) | (x >> (8 - shift))) & 0xff
+    sbox[p] = q ^ rotl(q, 1) ^ rotl(q, 2) ^ rotl(q, 3) ^ rotl(q, 4) ^ 0x63
+    if p == 1:
+      break
+  sbox[0] = 0x63
+
+  te0 = []
+  for value in sbox:
+    mul2 = _xtime(value) & 0xff
+    mul3 = mul2 ^ value
+    te0.append((mul2 << 24) | (value << 16) | (value << 8) | mul3)
+
+  ror = lambda x, shift: ((x >> shift) | (x << (32 - shift))) & 0xffffffff
+
+  return sbox, te0, [ror(x, 8) for x in te0], [ror(x, 16) for x in te0], [ror(x, 24) for x in te0]
+
+
+SBOX, TE0, TE1, TE2, TE3 = _gen_tables()
+
+
+def _transpose(buff):
+  # Transpose each 4x4 block of bytes of the buffer
+  result = bytearray(len(buff))
+  for row in range(0, 4):
+    for col in range(0, 4):
+      result[row*4+col::16] = buff[col*4+row::16]
+  return result
+
+
+
+class AesCtr(object):
+
+  def __init__(self, key, iv):
+
+    if len(key) != 32 or len(iv) != 16:
+      raise Exception('Invalid AES key or IV, expecting 32 and 16 hexadecimal digits, got %s and %s' % (key, iv))
+
+    key = _transpose(bytes.fromhex(key)[::-1])
+    iv = bytes.fromhex(iv)[::-1]
+
+    self.round_keys = self.__expand_key(key)
+
+    # Column words of the transposed counter block, the block counter is
+    # then just or-ed into the low byte of each word
+    self.counter_words = [(iv[col] << 24) | (iv[4+col] << 16) for col in range(0, 4)]
+
+    self.keystream = bytearray()
+
+  def __expand_key(self, key):
+    words = list(struct.unpack('>4I', key))
+    rcon = 1
+    for index in range(4, 44):
+      word = words[index-1]
+      if index % 4 == 0:
+        word = (SBOX[(word >> 16) & 0xff] << 24) | (SBOX[(word >> 8) & 0xff] << 16) | (SBOX[word & 0xff] << 8) | SBOX[word >> 24]
+        word ^= rcon << 24
+        rcon = _xtime(rcon) & 0xff
+      words.append(words[index-4] ^ word)
+    return words
+
+  def __encrypt_counter(self, words, counter):
+
+    rk = self.round_keys
+
+    s0 = (words[0] | (counter & 0xff)) ^ rk[0]
+    s1 = (words[1] | ((counter >> 8) & 0xff)) ^ rk[1]
+    s2 = (words[2] | ((counter >> 16) & 0xff)) ^ rk[2]
+    s3 = (words[3] | ((counter >> 24) & 0xff)) ^ rk[3]
+
+    for round in range(1, 10):
+      k = round * 4
+      t0 = TE0[s0 >> 24] ^ TE1[(s1 >> 16) & 0xff] ^ TE2[(s2 >> 8) & 0xff] ^ TE3[s3 & 0xff] ^ rk[k]
+      t1 = TE0[s1 >> 24] ^ TE1[(s2 >> 16) & 0xff] ^ TE2[(s3 >> 8) & 0xff] ^ TE3[s0 & 0xff] ^ rk[k+1]
+      t2 = TE0[s2 >> 24] ^ TE1[(s3 >> 16) & 0xff] ^ TE2[(s0 >> 8) & 0xff] ^ TE3[s1 & 0xff] ^ rk[k+2]
+      t3 = TE0[s3 >> 24] ^ TE1[(s0 >> 16) & 0xff] ^ TE2[(s1 >> 8) & 0xff] ^ TE3[s2 & 0xff] ^ rk[k+3]
+      s0, s1, s2, s3 = t0, t1, t2, t3
+
+    return (
+      (SBOX[s0 >> 24] << 24 | SBOX[(s1 >> 16) & 0xff] << 16 | SBOX[(s2 >> 8) & 0xff] << 8 | SBOX[s3 & 0xff]) ^ rk[40],
+      (SBOX[s1 >> 24] << 24 | SBOX[(s2 >> 16) & 0xff] << 16 | SBOX[(s3 >> 8) & 0xff] << 8 | SBOX[s0 & 0xff]) ^ rk[41],
+      (SBOX[s2 >> 24] << 24 | SBOX[(s3 >> 16) & 0xff] << 16 | SBOX[(s0 >> 8) & 0xff] << 8 | SBOX[s1 & 0xff]) ^ rk[42],
+      (SBOX[s3 >> 24] << 24 | SBOX[(s0 >> 16) & 0xff] << 16 | SBOX[(s1 >> 8) & 0xff] << 8 | SBOX[s2 & 0xff]) ^ rk[43]
+    )
+
+  def __gen_keystream(self, words, first, last):
+    # Returns the keystream blocks first to last - 1, computed from the
+    # counter block of block first, and the counter block of block last
+    blocks = bytearray((last - first) * 16)
+    for counter in range(first, last):
+      words = self.__encrypt_counter(words, counter)
+      struct.pack_into('>4I', blocks, (counter - first) * 16, *words)
+      # Only the last row of the block is replaced by the counter
+      words = [word & 0xffffff00 for word in words]
+    return _transpose(blocks), words
+
+  def get_keystream(self, size):
+
+    # As every buffer is encrypted with the block counter starting from 0,
+    # the keystream is the same for all of them, so its beginning is kept
+    # and only extended when a bigger buffer is encrypted
+    cached_size = min(size, KEYSTREAM_CACHE_SIZE)
+    if len(self.keystream) < cached_size:
+      blocks, self.counter_words = self.__gen_keystream(self.counter_words, len(self.keystream) // 16, (cached_size + 15) // 16)
+      self.keystream += blocks
+
+    if size <= len(self.keystream):
+      return memoryview(self.keystream)[:size]
+
+    blocks, words = self.__gen_keystream(self.counter_words, len(self.keystream) // 16, (size + 15) // 16)
+    return memoryview(self.keystream + blocks)[:size]
+
+  def encrypt(self, buff):
+    size = len(buff)
+    keystream = self.get_keystream(size)
+    value = int.from_bytes(buff, byteorder='little') ^ int.from_bytes(keystream, byteorder='little')
+    return value.to_bytes(size, byteorder='little')
+
+
+
+class AesCtrContext(ctypes.Structure):
+  _fields_ = [('State', ctypes.c_ubyte * 16), ('Counter', ctypes.c_uint)]
+
+
+class AesLibCtr(object):
+
+  # Encryption done by AesLib. The library keeps the expanded key in global
+  # variables, so it is expanded again for each buffer.
+  def __init__(self, lib, key, iv):
+
+    if len(key) != 32 or len(iv) != 16:
+      raise Exception('Invalid AES key or IV, expecting 32 and 16 hexadecimal digits, got %s and %s' % (key, iv))
+
+    self.lib = lib
+    self.key = bytes.fromhex(key)[::-1]
+    self.iv = bytes.fromhex(iv)[::-1]
+
+  def encrypt(self, buff):
+    size = len(buff)
+    # The key is modified by the key expansion
+    key = ctypes.create_string_buffer(self.key, 16)
+    iv = ctypes.create_string_buffer(self.iv, 8)
+    ctx = AesCtrContext()
+    result = ctypes.create_string_buffer(size)
+    self.lib.AesCtrInit(ctypes.byref(ctx), key, iv, 1)
+    self.lib.AesCtrStream(ctypes.byref(ctx), ctypes.create_string_buffer(bytes(buff), size), result, size)
+    return result.raw
+
+
+
+# AesLib, loaded only once, False until it is loaded. PLP_AES_LIB can give
+# the path of the library to be used.
+aes_lib = False
+
+
+def get_aes_lib():
+  global aes_lib
+  if aes_lib is False:
+    path = os.environ.get('PLP_AES_LIB')
+    if path is None:
+      path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libaes.so')
+    try:
+      aes_lib = ctypes.CDLL(path)
+    except OSError:
+      aes_lib = None
+      print ('WARNING: %s not found, images are slowly encrypted in Python, it is built by make sdk.build' % path)
+    else:
+      aes_lib.AesCtrInit.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+      aes_lib.AesCtrInit.restype = None
+      aes_lib.AesCtrStream.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+      aes_lib.AesCtrStream.restype = None
+      aes_lib.AesBuildLUT()
+  return aes_lib
+
+
+
+# Engines already created, indexed by key and IV, so that the beginning of
+# the keystream of the Python engine is only computed once for all the images
+# using the same ones
+aes_ctr_engines = {}
+
+
+def get_aes_ctr(key, iv):
+  engine = aes_ctr_engines.get((key, iv))
+  if engine is None:
+    lib = get_aes_lib()
+    if lib is not None:
+      engine = AesLibCtr(lib, key, iv)
+    else:
+      engine = AesCtr(key, iv)
+    aes_ctr_engines[(key, iv)] = engine
+  return engine
+
+
+def encrypt_buffers(key, iv, buffers):
+  # Each buffer is encrypted independently, with the block counter starting
+  # from 0
+  engine = get_aes_ctr(key, iv)
+  return [engine.encrypt(buff) for buff in buffers]
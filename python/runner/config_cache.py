@@ -0,0 +1,120 @@
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+
+
+# Memoized access to the interpreted configuration used by the runners.
+#
+# Runners look up the same '**/...' paths many times, and each lookup walks
+# the whole configuration tree. The results of the lookups done on the root
+# of the configuration are kept, indexed by method and path, until the
+# configuration is modified through a set() on the root or on any node
+# obtained from it, as this can change the result of any wildcard lookup.
+# Lookups with keyword arguments are forwarded without being memoized, as
+# are the other methods.
+
+# Lookup methods of the configuration which are memoized
+CACHED_METHODS = ['get', 'get_str', 'get_child_str', 'get_child_int', 'get_child_bool']
+
+
+
+class ConfigNode(object):
+
+    # Node obtained from the cached configuration, so that modifications done
+    # through it invalidate the cache
+    def __init__(self, cache, node):
+        self.cache = cache
+        self.node = node
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+
+    def get(self, *args, **kwargs):
+        result = self.node.get(*args, **kwargs)
+        if len(args) == 0 and len(kwargs) == 0:
+            return result
+        return self.cache.wrap(result)
+
+    def get_elem(self, *args, **kwargs):
+        return self.cache.wrap(self.node.get_elem(*args, **kwargs))
+
+    def set(self, *args, **kwargs):
+        self.cache.invalidate()
+        return self.node.set(*args, **kwargs)
+
+
+
+class CachedConfig(object):
+
+    def __init__(self, config, stats=False):
+        self.config = config
+        self.lookups = {}
+        # Lookups are only counted and timed if stats are enabled
+        self.stats = stats
+        self.nb_lookups = 0
+        self.nb_hits = 0
+        self.nb_invalidations = 0
+        self.lookup_time = 0
+
+    def __getattr__(self, name):
+        if name in CACHED_METHODS:
+            return lambda *args, **kwargs: self.__lookup(name, args, kwargs)
+        return getattr(self.config, name)
+
+    def __lookup(self, method, args, kwargs):
+        if not self.stats:
+            return self.__get(method, args, kwargs)
+
+        start = time.perf_counter()
+        self.nb_lookups += 1
+        result = self.__get(method, args, kwargs)
+        self.lookup_time += time.perf_counter() - start
+        return result
+
+    def __get(self, method, args, kwargs):
+        if len(kwargs) != 0:
+            return self.wrap(getattr(self.config, method)(*args, **kwargs))
+
+        key = (method, args)
+        if key in self.lookups:
+            if self.stats:
+                self.nb_hits += 1
+            return self.lookups[key]
+
+        result = self.wrap(getattr(self.config, method)(*args))
+        self.lookups[key] = result
+        return result
+
+    def wrap(self, result):
+        # Only configuration nodes are wrapped, values are returned as they are
+        if result is None or type(result) in [str, int, bool, float, list, dict] or isinstance(result, ConfigNode):
+            return result
+        return ConfigNode(self, result)
+
+    def invalidate(self):
+        if len(self.lookups) != 0:
+            self.nb_invalidations += 1
+            self.lookups = {}
+
+    def set(self, *args, **kwargs):
+        self.invalidate()
+        return self.config.set(*args, **kwargs)
+
+    def dump_stats(self):
+        if not self.stats:
+            return
+        print ('Config lookups: %d (hits: %d, invalidations: %d, time: %.3f ms)' % (self.nb_lookups, self.nb_hits, self.nb_invalidations, self.lookup_time * 1000))
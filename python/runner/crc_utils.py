@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import zlib
+
+
+# CRC used by the boot ROMs to check flash and EEPROM images. This is the
+# standard reflected CRC-32 (polynomial 0xEDB88320, initial value and final
+# xor 0xFFFFFFFF), so zlib is used to compute it.
+#
+# The CRC can be computed incrementally by passing the CRC of the previous
+# buffers, e.g. get_crc(b, get_crc(a)) == get_crc(a + b).
+
+def get_crc(buff, crc=0):
+  return zlib.crc32(buff, crc)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from elftools.elf.elffile import ELFFile
+from elftools.elf.sections import SymbolTableSection
+import mmap
+import os
+import os.path
+
+
+# ELF binaries parsed so far, indexed by their real path. Each entry also
+# keeps the modification time and size of the file when it was parsed so
+# that a binary rebuilt in the meantime is parsed again, in which case the
+# previous one is closed.
+elf_cache = {}
+
+
+
+class ElfSegment(object):
+
+  def __init__(self, segment, data):
+    self.base = segment['p_paddr']
+    self.vaddr = segment['p_vaddr']
+    self.offset = segment['p_offset']
+    self.filesz = segment['p_filesz']
+    self.memsz = segment['p_memsz']
+    self.data = data
+
+
+
+class Elf(object):
+
+  # The segments data are views on the mapped file. They are valid until the
+  # Elf is closed, which for binaries returned by get_elf happens when the
+  # file is modified and get_elf is called again for it. Using them after
+  # this raises a ValueError.
+  # As for any mapped file, the file must not be truncated or rewritten in
+  # place while the views are used, as accessing them would then crash the
+  # process with SIGBUS. Binaries are usually rebuilt by writing a new file,
+  # which keeps the mapped one unchanged.
+  def __init__(self, path):
+    self.path = path
+    self.realpath = os.path.realpath(path)
+    self.symbols = None
+
+    # The file is mapped instead of being read, so that segments data are
+    # only loaded from the file when they are accessed, and can be written
+    # from the mapping without any intermediate copy
+    with open(path, 'rb') as file:
+      self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    self.content = content = memoryview(self.map)
+
+    elffile = ELFFile(self.map)
+
+    self.entry = elffile['e_entry']
+
+    # Only loadable segments are kept, with their data being a view on the
+    # mapped file located with the segment file offset and size
+    self.segments = []
+    for segment in elffile.iter_segments():
+      if segment['p_type'] == 'PT_LOAD':
+        offset = segment['p_offset']
+        data = content[offset:offset+segment['p_filesz']]
+        self.segments.append(ElfSegment(segment, data))
+
+  def get_symbols(self):
+
+    # Symbols are only parsed the first time they are needed as this is much
+    # slower than getting the segments
+    if self.symbols is None:
+      self.symbols = {}
+      elffile = ELFFile(self.map)
+      for section in elffile.iter_sections():
+        if isinstance(section, SymbolTableSection):
+          for symbol in section.iter_symbols():
+            if symbol.name != '':
+              self.symbols[symbol.name] = symbol['st_value']
+
+    return self.symbols
+
+  def get_symbol(self, name):
+    return self.get_symbols().get(name)
+
+  def close(self):
+    if self.map is None:
+      return
+
+    for segment in self.segments:
+      segment.data.release()
+    self.content.release()
+
+    # If views on the segments data are still used elsewhere, the file is
+    # only unmapped once they are all released
+    try:
+      self.map.close()
+    except BufferError:
+      pass
+    self.map = None
+
+    entry = elf_cache.get(self.realpath)
+    if entry is not None and entry[1] is self:
+      del elf_cache[self.realpath]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+
+def get_elf(path):
+
+  stat = os.stat(path)
+  realpath = os.path.realpath(path)
+  key = (realpath, stat.st_mtime_ns, stat.st_size)
+
+  entry = elf_cache.get(realpath)
+  if entry is None or entry[0] != key:
+    if entry is not None:
+      entry[1].close()
+    entry = (key, Elf(path))
+    elf_cache[realpath] = entry
+
+  return entry[1]
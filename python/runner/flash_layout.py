@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+
+
+# Layout of the flash images read by the ROM, shared by all the flash image
+# builders: the boot binary areas described by the boot header, followed by
+# either a raw file system or the components table and components.
+
+
+
+class FlashArea(object):
+
+    def __init__(self, offset, base, size, nbBlocks):
+        self.offset = offset
+        self.base = base
+        self.size = size
+        self.nbBlocks = nbBlocks
+
+
+class FlashCompArea(object):
+
+    def __init__(self, name, flashAddr, size):
+        self.name = name
+        self.flashAddr = flashAddr
+        self.size = size
+
+
+class FlashLayout(object):
+
+    # Flash offset, memory base, size and number of blocks of each boot binary
+    # area as declared in the boot header, and flash offset and size of each
+    # component
+    def __init__(self, blockSize):
+        self.blockSize = blockSize
+        self.bootAreas = []
+        self.fsOffset = None
+        self.compsOffset = None
+        self.comps = []
+        self.size = 0
+
+
+class FlashImageInfo(FlashLayout):
+
+    # Layout of a generated flash image, with its output files
+    def __init__(self, image):
+        FlashLayout.__init__(self, image.blockSize)
+        self.raw = image.raw
+        self.stimuli = image.stimuli
+        self.size = image.size
+        self.bootAreas = [FlashArea(area.offset, area.base, area.size, area.nbBlocks) for area in image.bootAreas]
+        self.fsOffset = image.fsOffset
+        self.compsOffset = image.compsOffset
+        self.comps = [FlashCompArea(comp.name, comp.flashAddr, comp.size) for comp in image.flashComps]
+
+
+def getSameComps(comps):
+    # Returns for each component the first previous one with the same
+    # content, or None if there is none, so that they can share their flash
+    # data. Only the content of components having the same size as another
+    # one is read to compare it.
+    sizes = {}
+    for comp in comps:
+        sizes[comp.size] = sizes.get(comp.size, 0) + 1
+
+    storedComps = {}
+    sameComps = []
+    for comp in comps:
+        if sizes[comp.size] == 1:
+            sameComps.append(None)
+        else:
+            sameComps.append(storedComps.get(comp.get_hash()))
+            if sameComps[-1] is None:
+                storedComps[comp.get_hash()] = comp
+
+    return sameComps
+
+
+def planFlashImage(image, raw_fs=None):
+
+    # Compute the layout of the image as it would be generated, only from
+    # the segments and files sizes and without modifying the image.
+    # As padding to an offset which has already been passed moves the
+    # flash offset back without removing anything, the flash offset and
+    # the actual image size are tracked separately.
+    # Only the headers are computed, except with dedup, where the components
+    # with the same size as another one are read to compare their content.
+    layout = FlashLayout(image.blockSize)
+    encryptSize = 4 if image.encrypt else 0
+    roundToBlock = lambda size: (size + image.blockSize - 1) // image.blockSize * image.blockSize
+
+    if image.bootBinary is None:
+        flashOffset = size = 8
+
+    elif image.archi == 'vivosoc2' or image.archi == 'fulmine':
+        # Segments are merged into an L2 and an L1 area, with their data
+        # padded to blocks after a header of 2 areas
+        sizes = {0x1c000000: 0, 0x10000000: 0}
+        for segment in image.bootBinary.segments:
+            if segment.base < 0x1c000000: base = 0x10000000
+            else: base = 0x1c000000
+            if segment.base > base + sizes[base]:
+                sizes[base] = segment.base - base
+            sizes[base] += len(segment.data)
+
+        flashOffset = 4*4*2
+        offset = flashOffset
+        for base in [0x1c000000, 0x10000000]:
+            area = FlashArea(offset, base, sizes[base], roundToBlock(sizes[base]) // image.blockSize)
+            layout.bootAreas.append(area)
+            offset += area.nbBlocks * image.blockSize
+            flashOffset += roundToBlock(sizes[base] + encryptSize)
+        size = flashOffset
+
+    else:
+        # Each segment starts on a block after the header and its CRC, and
+        # the next descriptor starts after them on 8 bytes
+        headerSize = 4 + 4 + 4 + 4 + 16 * 4 * len(image.bootBinary.segments) + 4
+        offset = roundToBlock(headerSize)
+        for segment in image.bootBinary.segments:
+            areaSize = len(segment.data) + encryptSize
+            area = FlashArea(offset, segment.base, areaSize, roundToBlock(areaSize) // image.blockSize)
+            layout.bootAreas.append(area)
+            offset += area.nbBlocks * image.blockSize
+
+        layout.fsOffset = (offset + 7) & ~7
+
+        flashOffset = size = headerSize + encryptSize
+        for area in layout.bootAreas:
+            size += max(area.offset - flashOffset, 0) + area.size
+            flashOffset = area.offset + area.size
+        size += max(layout.fsOffset - flashOffset, 0)
+        flashOffset = layout.fsOffset
+
+    layout.compsOffset = flashOffset
+
+    if raw_fs is not None:
+        layout.size = size + os.path.getsize(raw_fs) + encryptSize
+        return layout
+
+    # Components addresses are computed from the header size without
+    # encryption, while the image grows with the CRC of each buffer
+    headerSize = 12
+    flashOffset += 12
+    for comp in image.compList:
+        headerSize += 12 + len(comp.name) + 1
+        flashOffset += 12 + len(comp.name.encode('utf-8')) + encryptSize + 1
+    size += flashOffset - layout.compsOffset
+
+    if image.dedup:
+        sameComps = getSameComps(image.compList)
+    else:
+        sameComps = [None] * len(image.compList)
+
+    flashAddr = layout.compsOffset + headerSize
+    compAreas = {}
+    for comp, sameComp in zip(image.compList, sameComps):
+        if sameComp is not None:
+            layout.comps.append(FlashCompArea(comp.name, compAreas[sameComp].flashAddr, comp.size))
+            continue
+
+        flashAddr = (flashAddr + 3) & ~3
+        layout.comps.append(FlashCompArea(comp.name, flashAddr, comp.size))
+        compAreas[comp] = layout.comps[-1]
+        size += max(flashAddr - flashOffset, 0) + comp.size + encryptSize
+        flashOffset = flashAddr + comp.size + encryptSize
+        flashAddr += comp.size
+
+    layout.size = size
+
+    return layout
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import struct
+import runner.crc_utils as crc_utils
+import runner.aes_utils as aes_utils
+
+
+# Common engine of the flash and EEPROM image builders.
+#
+# The image is a list of parts which are only assembled when the image is
+# written or its content is needed:
+#   - buffers, which can still be modified to patch offsets or CRCs,
+#   - files, which are copied to the output file without going through
+#     memory when possible,
+#   - encrypted buffers, which are encrypted when the image is assembled,
+#     as each buffer is encrypted independently of the others. All the
+#     buffers of the image are encrypted with a single call.
+
+
+
+def copyFile(file, path, size):
+    # Copy the file into the output one inside the kernel when possible, so
+    # that it does not go through memory
+    with open(path, 'rb') as src:
+        offset = 0
+        try:
+            while offset < size:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(src.fileno(), file.fileno(), size - offset)
+                else:
+                    copied = os.sendfile(file.fileno(), src.fileno(), None, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except (AttributeError, OSError):
+            src.seek(offset)
+            shutil.copyfileobj(src, file)
+            offset = size
+
+        if offset != size:
+            raise Exception('File %s was modified while generating image' % path)
+
+
+def packCrc(buff, offset):
+    # Store at the specified offset the CRC of the buffer content before it
+    struct.pack_into("I", buff, offset, crc_utils.get_crc(memoryview(buff)[:offset]))
+
+
+
+class Record(object):
+
+    # Header record made of fixed-size little-endian fields
+    def __init__(self, fmt, fields):
+        self.struct = struct.Struct('<' + fmt)
+        self.fields = fields
+        self.size = self.struct.size
+
+    def pack(self, *values):
+        return self.struct.pack(*values)
+
+    def packInto(self, buff, offset, *values):
+        self.struct.pack_into(buff, offset, *values)
+
+    def getValues(self, obj):
+        return [getattr(obj, field) for field in self.fields]
+
+    def packObject(self, obj):
+        return self.struct.pack(*self.getValues(obj))
+
+    def packObjectInto(self, buff, offset, obj):
+        self.struct.pack_into(buff, offset, *self.getValues(obj))
+
+
+
+class AesEncryption(object):
+
+    # Encryption expected by the boot code, the CRC of the buffer is appended
+    # to it and the result is encrypted with AES-128-CTR
+    def __init__(self, key, iv):
+        self.key = key
+        self.iv = iv
+
+    def get_size(self, size):
+        return size + 4
+
+    def encrypt_buffers(self, buffers):
+        return aes_utils.encrypt_buffers(self.key, self.iv, [bytes(buff) + struct.pack("I", crc_utils.get_crc(buff)) for buff in buffers])
+
+
+
+class FilePart(object):
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def get_size(self):
+        return self.size
+
+    def get_data(self):
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def write(self, file):
+        file.flush()
+        copyFile(file, self.path, self.size)
+
+
+
+class EncryptedPart(object):
+
+    def __init__(self, data, encryption):
+        self.data = data
+        self.encryption = encryption
+
+    def get_size(self):
+        return self.encryption.get_size(len(self.data))
+
+    def get_data(self):
+        return self.encryption.encrypt_buffers([self.data])[0]
+
+
+
+class ImageBuilder(object):
+
+    def __init__(self, blockSize=None, encryption=None, stream=False):
+        self.blockSize = blockSize
+        self.encryption = encryption
+        # Files are only read when the image is assembled if they do not need
+        # to be encrypted
+        self.stream = stream and encryption is None
+        self.parts = []
+        self.buff = bytearray()
+        # Offset where the next data is appended. Padding to an offset which
+        # has already been passed moves it back without removing anything
+        # from the image.
+        self.offset = 0
+
+    def __closeBuff(self):
+        if len(self.buff) != 0:
+            self.parts.append(self.buff)
+            self.buff = bytearray()
+
+    def __addPart(self, part):
+        self.__closeBuff()
+        self.parts.append(part)
+        self.offset += part.get_size()
+
+    def pad(self, size):
+        self.offset += size
+        self.buff += bytes(max(size, 0))
+
+    def padToOffset(self, offset):
+        self.pad(offset - self.offset)
+
+    def padBlock(self, size):
+        self.pad((size + self.blockSize - 1) // self.blockSize * self.blockSize - size)
+
+    def roundToNextBlock(self):
+        self.padToOffset((self.offset + self.blockSize - 1) // self.blockSize * self.blockSize)
+
+    def appendRecord(self, record, *values):
+        self.buff += record.pack(*values)
+        self.offset += record.size
+
+    def appendObject(self, record, obj):
+        self.appendRecord(record, *record.getValues(obj))
+
+    def appendInt(self, value):
+        self.appendRecord(INT, value)
+
+    def appendLongInt(self, value):
+        self.appendRecord(LONG, value)
+
+    def appendByte(self, value):
+        self.appendRecord(BYTE, value)
+
+    def getBufferSize(self, size):
+        # Size taken in the image by a buffer once appended
+        if self.encryption is not None:
+            return self.encryption.get_size(size)
+        return size
+
+    def appendBuffer(self, buff, pad=False, padToOffset=None):
+        if padToOffset is not None:
+            self.padToOffset(padToOffset)
+
+        if self.encryption is not None:
+            part = EncryptedPart(buff, self.encryption)
+            size = part.get_size()
+            self.__addPart(part)
+        else:
+            size = len(buff)
+            self.buff += buff
+            self.offset += size
+
+        if pad:
+            self.padBlock(size)
+
+    def appendFile(self, path, size, padToOffset=None):
+        if not self.stream:
+            with open(path, 'rb') as file:
+                self.appendBuffer(file.read(), padToOffset=padToOffset)
+        else:
+            if padToOffset is not None:
+                self.padToOffset(padToOffset)
+            self.__addPart(FilePart(path, size))
+
+    def reserve(self, size):
+        # Reserve a region which is returned as a buffer so that its content
+        # can be patched until the image is assembled. It is encrypted as a
+        # whole if encryption is active.
+        region = bytearray(size)
+        if self.encryption is not None:
+            self.__addPart(EncryptedPart(region, self.encryption))
+        else:
+            self.__closeBuff()
+            self.parts.append(region)
+            self.offset += size
+        return region
+
+    def get_size(self):
+        size = len(self.buff)
+        for part in self.parts:
+            if type(part) == bytearray:
+                size += len(part)
+            else:
+                size += part.get_size()
+        return size
+
+    def __encryptParts(self):
+        # Returns the content of the encrypted parts, in the image order
+        parts = [part for part in self.parts if type(part) == EncryptedPart]
+        if len(parts) == 0:
+            return iter([])
+        return iter(self.encryption.encrypt_buffers([part.data for part in parts]))
+
+    def get_buffer(self):
+        # Assemble all the parts into a single buffer, which then replaces them
+        if len(self.parts) != 0:
+            encrypted = self.__encryptParts()
+            buff = bytearray()
+            for part in self.parts:
+                if type(part) == bytearray:
+                    buff += part
+                elif type(part) == EncryptedPart:
+                    buff += next(encrypted)
+                else:
+                    buff += part.get_data()
+            buff += self.buff
+            self.parts = []
+            self.buff = buff
+        return self.buff
+
+    def write(self, file):
+        encrypted = self.__encryptParts()
+        for part in self.parts:
+            if type(part) == bytearray:
+                file.write(part)
+            elif type(part) == EncryptedPart:
+                file.write(next(encrypted))
+            else:
+                part.write(file)
+        file.write(self.buff)
+
+
+
+INT = Record("I", ['value'])
+LONG = Record("Q", ['value'])
+BYTE = Record("B", ['value'])
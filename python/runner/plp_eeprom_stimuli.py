@@ -12,9 +12,9 @@
 #
 
 import os
-import struct
-from elftools.elf.elffile import ELFFile
-import subprocess
+import hashlib
+import runner.elf_loader as elf_loader
+import runner.image_builder as image_builder
 
 
 
@@ -28,7 +28,7 @@ class BinarySegment(object):
 
 class Boot_callback(object):
 
-    def __init__(self, elf=None):
+    def __init__(self, elf=None, maxGap=None):
         self.segments = []
 
         if elf != None:
@@ -36,115 +36,75 @@ class Boot_callback(object):
             callback, path = elf.split(':')
             self.callback = int(callback)
 
-            with open(path, 'rb') as file:
-                elffile = ELFFile(file)
-    
-                self.entry = elffile['e_entry']
+            elffile = elf_loader.get_elf(path)
 
-                for segment in elffile.iter_segments():
-                    if segment['p_type'] == 'PT_LOAD':
-                        self.segments.append(BinarySegment(segment['p_paddr'], segment.data()))
+            self.entry = elffile.entry
 
+            for segment in elffile.segments:
+                if len(segment.data) != 0:
+                    self.segments.append(BinarySegment(segment.base, segment.data))
 
-class Image(object):
+            self.__mergeSegments(path, maxGap)
 
-    def __init__(self, raw=None, verbose=True, encrypt=False, aesKey=None, aesIv=None):
-
-        self.raw = raw
-        self.buff = []
-        self.eeprom_offset = 0
-        self.verbose = verbose
-        self.encrypt = encrypt
-        self.aesKey = aesKey
-        self.aesIv = aesIv
-        self.boot_callbacks = []
+    def __mergeSegments(self, path, maxGap):
+        # The ROM loads each callback with a single transfer, so all its
+        # segments are merged into one area, with the gaps between them
+        # filled with 0. Segments too far from each other would fill the
+        # EEPROM with zeros and are rejected.
+        if len(self.segments) == 0:
+            raise Exception('Boot callback %s does not have any loadable segment' % path)
 
+        segments = sorted(self.segments, key=lambda segment: segment.base)
 
+        self.base = segments[0].base
 
-    def add_boot_callback(self, callback):
-        self.boot_callbacks.append(Boot_callback(elf=callback))
-    
-    def __roundToNextBlock(self):
-        nextOffset = (int)((self.eeprom_offset + self.blockSize - 1) / self.blockSize) * self.blockSize
-        padding = nextOffset - self.eeprom_offset
-        self.eeprom_offset = nextOffset
-        for i in range(0, padding):
-            self.buff.append(0)
-
-    def __padBlock(self, size):
-        padsize = (int)((size + self.blockSize - 1) / self.blockSize) * self.blockSize - size
-        self.eeprom_offset += padsize
-        for i in range(0, padsize):
-            self.buff.append(0)
-
-    def __pad(self, padsize, buff=None):
-        if buff is None:
-            self.eeprom_offset += padsize
-            for i in range(0, padsize):
-                self.buff.append(0)
-        else:
-            for i in range(0, padsize):
-                buff = self.__appendByte(0, buff=buff)
-            return buff
-
-    def __appendInt(self, value, newBlock=False, buff=None):
-        if buff is None:
-            #if newBlock: self.__roundToNextBlock()
-            self.buff += struct.pack("I", value)
-            self.eeprom_offset += 4
-        else:
-            buff += struct.pack("I", value)
-            return buff
-
-    def __appendByte(self, value, newBlock=False, buff=None):
-        if buff is None:
-            #if newBlock: self.__roundToNextBlock()
-            self.buff += struct.pack("B", value)
-            self.eeprom_offset += 1
+        if len(segments) == 1:
+            self.data = segments[0].data
         else:
-            buff += struct.pack("B", value)
-            return buff
+            self.data = bytearray()
+            for segment in segments:
+                if segment.base < self.base + len(self.data):
+                    raise Exception('Boot callback %s has overlapping segments at 0x%x' % (path, segment.base))
+                gap = segment.base - self.base - len(self.data)
+                if maxGap is not None and gap > maxGap:
+                    raise Exception('Boot callback %s has a gap of 0x%x bytes before segment at 0x%x (max: 0x%x), its segments must be contiguous' % (path, gap, segment.base, maxGap))
+                self.data += bytes(gap)
+                self.data += segment.data
 
+        self.size = len(self.data)
 
-    def get_crc(self, buff):
-        crc = 0xffffffff
-        for data in buff:
-            crc = crc ^ data
-            for i in range(7, -1, -1):
-                if crc & 1 == 1:
-                    mask = 0xffffffff
-                else:
-                    mask = 0
-                crc2 = crc >> 1
-                crc = (crc >> 1) ^ (0xEDB88320 & mask)
 
-        return (crc ^ 0xffffffff)
+# Boot callback descriptor, the header contains one per callback
+EEPROM_CALLBACK = image_builder.Record("IIII", ['i2c_addr', 'l2_addr', 'i2c_size', 'entry'])
 
 
-    def __appendBuffer(self, buffer, newBlock=False, pad=False, encrypt=False, padToOffset=None):
-        #if newBlock: self.__roundToNextBlock()
-        if self.encrypt:
-            cmd = 'aes_encode %s %s' % (self.aesKey, self.aesIv)
-
-            crc = self.get_crc(buffer)
-            buffer += struct.pack("I", crc)
-
-            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-            out, err = p.communicate(buffer)
-            if p.returncode != 0:
-                raise Exception('Error when executing aes_encore to encrypt binary, probably this tool is not available')
-            buffer = out
+class Image(object):
 
-        if padToOffset != None:
-            self.__pad(padToOffset - self.eeprom_offset)
+    def __init__(self, raw=None, verbose=True, encrypt=False, aesKey=None, aesIv=None, pageSize=128, size=None):
 
-        self.buff += buffer
-        self.eeprom_offset += len(buffer)
-        if pad:
-            self.__padBlock(len(buffer))
+        self.raw = raw
+        self.verbose = verbose
+        self.encrypt = encrypt
+        self.aesKey = aesKey
+        self.aesIv = aesIv
+        self.boot_callbacks = []
+        # Callbacks start on a page boundary so that the ROM only reads full
+        # pages
+        self.pageSize = pageSize
+        # Size of the EEPROM, the image is rejected if it does not fit
+        self.size = size
+        if encrypt:
+            encryption = image_builder.AesEncryption(aesKey, aesIv)
+        else:
+            encryption = None
+        self.image = image_builder.ImageBuilder(encryption=encryption)
 
 
 
+    def add_boot_callback(self, callback):
+        # Only gaps up to 2 pages between the callback segments are filled
+        self.boot_callbacks.append(Boot_callback(elf=callback, maxGap=2 * self.pageSize))
+    
     def __dumpToBuff(self):
 
         callbacks = [None] * 32
@@ -152,40 +112,44 @@ class Image(object):
         for callback in self.boot_callbacks:
             callbacks[callback.callback] = callback
 
-        header_buff = bytes([])
+        header_buff = self.image.reserve(len(callbacks) * EEPROM_CALLBACK.size)
 
         # Reserve one more entry to store CRC
         callbacks_offset = 4 * 4 * 33
 
-        for callback in callbacks:
+        for index, callback in enumerate(callbacks):
             i2c_addr = 0
             l2_addr = 0
             i2c_size = 0
             entry = 0
 
             if callback is not None:
-                callbacks_offset = (callbacks_offset + 127) & ~0x7f
+                callbacks_offset = (callbacks_offset + self.pageSize - 1) // self.pageSize * self.pageSize
                 callback.i2c_addr = callbacks_offset
                 i2c_addr = callback.i2c_addr
-                l2_addr = callback.segments[0].base
-                i2c_size = callback.segments[0].size + 4
+                l2_addr = callback.base
+                i2c_size = callback.size + 4
                 entry = callback.entry
 
-                callbacks_offset += callback.segments[0].size
+                if self.verbose:
+                    print ('  Callback %d: i2c addr: 0x%x, l2 addr: 0x%x, size: 0x%x, entry: 0x%x' % (index, i2c_addr, l2_addr, callback.size, entry))
+
+                callbacks_offset += self.image.getBufferSize(callback.size)
 
-            header_buff = self.__appendInt(i2c_addr, buff=header_buff)
-            header_buff = self.__appendInt(l2_addr, buff=header_buff)
-            header_buff = self.__appendInt(i2c_size, buff=header_buff)
-            header_buff = self.__appendInt(entry, buff=header_buff)
+            EEPROM_CALLBACK.packInto(header_buff, index * EEPROM_CALLBACK.size, i2c_addr, l2_addr, i2c_size, entry)
 
-        self.__appendBuffer(header_buff, encrypt=self.encrypt)
+        if self.size is not None and callbacks_offset > self.size:
+            raise Exception('EEPROM image is too big (size: 0x%x, EEPROM size: 0x%x)' % (callbacks_offset, self.size))
 
         for callback in callbacks:
             if callback is not None:
-                self.__pad(callback.i2c_addr - self.eeprom_offset)
-                self.__appendBuffer(callback.segments[0].data, encrypt=self.encrypt)
+                self.image.appendBuffer(callback.data, padToOffset=callback.i2c_addr)
+
 
 
+    def get_content(self):
+        self.__dumpToBuff()
+        return bytes(self.image.get_buffer())
 
     def generate(self):
 
@@ -198,4 +162,78 @@ class Image(object):
                 pass
 
             with open(self.raw, 'wb') as file:
-                file.write(bytes(self.buff))
+                self.image.write(file)
+
+
+
+def getCallbackHash(callback):
+    # Callbacks are identified by their index and the content of their binary
+    index, path = callback.split(':')
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return (int(index), digest.hexdigest())
+
+
+# Version of the image layout, to be increased when it is modified so that
+# the images already cached on disk are not used anymore
+EEPROM_CACHE_VERSION = 1
+
+
+def getCacheFile(key):
+    # Images are kept on disk, indexed by their callbacks and generation
+    # options, so that the same image is not built again by each process
+    # generating it for a test
+    path = os.environ.get('PLP_EEPROM_CACHE_DIR')
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.plp_eeprom')
+    return os.path.join(path, '%s.bin' % hashlib.sha256(repr(key).encode('utf-8')).hexdigest())
+
+
+def genEepromImage(raw=None, callbacks=[], verbose=False, encrypt=False, aesKey=None, aesIv=None, pageSize=128, size=None):
+    if raw is None or len(callbacks) == 0:
+        return None
+
+    key = (EEPROM_CACHE_VERSION, tuple([getCallbackHash(callback) for callback in callbacks]), encrypt, aesKey, aesIv, pageSize, size)
+    cache_file = getCacheFile(key)
+
+    try:
+        with open(cache_file, 'rb') as file:
+            content = file.read()
+        if verbose:
+            print ('Reusing EEPROM image (raw: %s, cache: %s)' % (raw, cache_file))
+    except IOError:
+        content = None
+
+    if content is None:
+        if verbose:
+            print ('Building EEPROM image (raw: %s)' % raw)
+
+        image = Image(verbose=verbose, encrypt=encrypt, aesKey=aesKey, aesIv=aesIv, pageSize=pageSize, size=size)
+        for callback in callbacks:
+            image.add_boot_callback(callback)
+
+        content = image.get_content()
+
+        # The image is written under a temporary name so that a concurrent
+        # process never reads a partial image
+        try:
+            os.makedirs(os.path.dirname(cache_file))
+        except:
+            pass
+
+        tmp_file = '%s.%d' % (cache_file, os.getpid())
+        with open(tmp_file, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_file, cache_file)
+
+    try:
+        os.makedirs(os.path.dirname(raw))
+    except:
+        pass
+
+    with open(raw, 'wb') as file:
+        file.write(content)
+
+    return content
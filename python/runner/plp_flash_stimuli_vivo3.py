@@ -11,9 +11,12 @@
 #
 
 import os
+import hashlib
 import struct
-from elftools.elf.elffile import ELFFile
-import subprocess
+import runner.elf_loader as elf_loader
+import runner.image_builder as image_builder
+import runner.flash_layout as flash_layout
+import runner.slm_utils as slm_utils
 
 
 
@@ -34,12 +37,26 @@ def dump_word( filetoprint, addr, data_s):
         filetoprint.write("@%08X %s\n" % ( addr+i,  data_s[i*2:(i+1)*2] ))
     return 4
 
+# Number of bits set in each byte value
+POPCOUNT_TABLE = bytes([bin(value).count("1") for value in range(0, 256)])
+
 class Comp(object):
 
     def __init__(self, dirpath, name):
         self.path = os.path.join(dirpath, name)
         self.name = name
         self.size = os.path.getsize(self.path)
+        self.hash = None
+        self.stored = True
+
+    def get_hash(self):
+        if self.hash is None:
+            digest = hashlib.sha256()
+            with open(self.path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.hash = (self.size, digest.hexdigest())
+        return self.hash
 
     def dump(self):
         print (self.name)
@@ -62,29 +79,49 @@ class Binary(object):
 
         if elf != None:
 
-            with open(elf, 'rb') as file:
-                elffile = ELFFile(file)
-    
-                self.entry = elffile['e_entry']
+            elffile = elf_loader.get_elf(elf)
+
+            self.entry = elffile.entry
+
+            for segment in elffile.segments:
+                self.segments.append(BinarySegment(segment.base, segment.data))
+
+
+class FlashImageInfo(flash_layout.FlashImageInfo):
 
-                for segment in elffile.iter_segments():
-                    if segment['p_type'] == 'PT_LOAD':
-                        self.segments.append(BinarySegment(segment['p_paddr'], segment.data()))
+    # Layout of a generated flash image, with its output files
+    def __init__(self, image):
+        flash_layout.FlashImageInfo.__init__(self, image)
+        self.sysDescr = image.sysDescr
+        self.binDescr = image.binDescr
+
+
+# Boot header and boot areas descriptors read by the ROM
+FLASH_HEADER = image_builder.Record("IIII", ['fsOffset', 'nbAreas', 'entry', 'bootaddr'])
+FLASH_AREA = image_builder.Record("IIII", ['offset', 'base', 'size', 'nbBlocks'])
+
+# Binary descriptor of the NAND boot, followed by one entry per section
+BIN_DESCR_HEADER = image_builder.Record("III", ['nbSections', 'entry', 'bootaddr'])
+BIN_DESCR_SECTION = image_builder.Record("IIII", ['flashAddr', 'base', 'size', 'nbBlocks'])
 
 
 class FlashImage(object):
 
-    def __init__(self, raw=None, sysDescr=None, binDescr=None, stimuli=None, verbose=True, archi=None, encrypt=False, aesKey=None, aesIv=None, flashType='spi', qpi=True):
+    def __init__(self, raw=None, sysDescr=None, binDescr=None, stimuli=None, verbose=True, archi=None, encrypt=False, aesKey=None, aesIv=None, flashType='spi', qpi=True, dedup=False):
 
         self.bootBinary = None
         self.raw = raw
         self.stimuli = stimuli
         self.compList = []
-        self.buff = []
-        self.buffSect = []
+        self.bootAreas = []
+        self.flashComps = []
+        self.compsOffset = None
+        self.fsOffset = None
+        self.size = 0
+        self.buffSect = bytearray()
 
         self.sysDescr = sysDescr
-        self.buffSysDescr = []
+        self.buffSysDescr = bytearray()
         self.sysNumChips = 2
         self.sysChipID = [0x54523230, 0x56533331]
         self.sysMaxBins = 6
@@ -93,12 +130,11 @@ class FlashImage(object):
         self.sysBinPtrs[0] = [0xA0000, 0xC0000]
         self.sysBinPtrs[1] = [0x20000, 0x40000]
 
-        self.buffBinDescr = []
+        self.buffBinDescr = bytearray()
         self.binDescr = binDescr
         self.binFlashAddr = 0x120000
         self.binMaxSect = 16
 
-        self.flashOffset = 0
         if flashType == 'hyper': self.blockSize = 1024
         elif flashType == 'nand': self.blockSize = 2048
         else: self.blockSize = 4096
@@ -110,6 +146,14 @@ class FlashImage(object):
         self.aesIv = aesIv
         self.flashType = flashType
         self.qpi = qpi
+        self.dedup = dedup
+        if encrypt:
+            encryption = image_builder.AesEncryption(aesKey, aesIv)
+        else:
+            encryption = None
+        # Files are only copied when the raw image is produced if it is the
+        # only output
+        self.image = image_builder.ImageBuilder(blockSize=self.blockSize, encryption=encryption, stream=stimuli is None)
 
 
 
@@ -120,112 +164,14 @@ class FlashImage(object):
 
         self.compList.append(Comp(dirname, name))
 
-    def __roundToNextBlock(self):
-        nextOffset = (int)((self.flashOffset + self.blockSize - 1) / self.blockSize) * self.blockSize
-        padding = nextOffset - self.flashOffset
-        self.flashOffset = nextOffset
-        for i in range(0, padding):
-            self.buff.append(0)
-
-    def __padBlock(self, size):
-        padsize = (int)((size + self.blockSize - 1) / self.blockSize) * self.blockSize - size
-        self.flashOffset += padsize
-        for i in range(0, padsize):
-            self.buff.append(0)
-
-    def __pad(self, padsize, buff=None):
-        if buff is None:
-            self.flashOffset += padsize
-            for i in range(0, padsize):
-                self.buff.append(0)
-        else:
-            for i in range(0, padsize):
-                buff = self.__appendByte(0, buff=buff)
-            return buff
-
-    def __appendInt(self, value, newBlock=False, buff=None):
-        if buff is None:
-            #if newBlock: self.__roundToNextBlock()
-            self.buff += struct.pack("I", value)
-            self.flashOffset += 4
-        else:
-            buff += struct.pack("I", value)
-            return buff
-
-    def __appendLongInt(self, value, newBlock=False, buff=None):
-        if buff is None:
-            #if newBlock: self.__roundToNextBlock()
-            self.buff += struct.pack("Q", value)
-            self.flashOffset += 8
-        else:
-            buff += struct.pack("Q", value)
-            return buff
-
-    def __appendByte(self, value, newBlock=False, buff=None):
-        if buff is None:
-            #if newBlock: self.__roundToNextBlock()
-            self.buff += struct.pack("B", value)
-            self.flashOffset += 1
-        else:
-            buff += struct.pack("B", value)
-            return buff
-
-
-    def get_crc(self, buff):
-        crc = 0xffffffff
-        for data in buff:
-            crc = crc ^ data
-            for i in range(7, -1, -1):
-                if crc & 1 == 1:
-                    mask = 0xffffffff
-                else:
-                    mask = 0
-                crc2 = crc >> 1
-                crc = (crc >> 1) ^ (0xEDB88320 & mask)
-
-        return (crc ^ 0xffffffff)
-
-
-    def __appendBuffer(self, buffer, newBlock=False, pad=False, encrypt=False, padToOffset=None):
-        #if newBlock: self.__roundToNextBlock()
-        if self.encrypt:
-            cmd = 'aes_encode %s %s' % (self.aesKey, self.aesIv)
-
-            crc = self.get_crc(buffer)
-            buffer += struct.pack("I", crc)
-
-            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-            out, err = p.communicate(buffer)
-            if p.returncode != 0:
-                raise Exception('Error when executing aes_encore to encrypt binary, probably this tool is not available')
-            buffer = out
-
-        if padToOffset != None:
-            self.__pad(padToOffset - self.flashOffset)
-
-        self.buff += buffer
-        self.flashOffset += len(buffer)
-        if pad:
-            self.__padBlock(len(buffer))
-
-
-    def __appendSection(self, buffer, encrypt=False):
-        if len(buffer) % self.blockSize == 0:
-            nbPages = len(buffer) / self.blockSize
-        else:
-            nbPages = len(buffer) // self.blockSize + 1
+    def __appendSection(self, buffer):
+        nbPages = (len(buffer) + self.blockSize - 1) // self.blockSize
 
         if self.verbose: print ("Section dump: length: 0x%x, nbPages: %d" % (len(buffer),nbPages))
 
-        for i in range(nbPages):
-            if i == (nbPages-1):
-                #print ("Section partial: length: 0x%x" % (len(buffer)%self.blockSize))
-                self.buffSect += buffer[i*self.blockSize:i*self.blockSize+(len(buffer)%self.blockSize)]
-                #print ("Section pad: length: 0x%x" % (self.blockSize-(len(buffer)%self.blockSize)))
-                for j in range(self.blockSize-(len(buffer)%self.blockSize)):
-                    self.buffSect.append(0)
-            else:
-                self.buffSect += buffer[i*self.blockSize:(i+1)*self.blockSize]
+        # Sections are written by full pages, the last one being padded with 0
+        self.buffSect += buffer
+        self.buffSect += bytes(nbPages * self.blockSize - len(buffer))
 
 
     def __dumpToBuff(self):
@@ -243,8 +189,8 @@ class FlashImage(object):
             if self.verbose: print ("  Area %d: base: 0x%x, size: 0x%x" % (index, segment.base, segment.size))
             index = index + 1
 
-        l1Area =  BinarySegment(0x10000000, [])
-        l2Area =  BinarySegment(0x1c000000, [])
+        l1Area =  BinarySegment(0x10000000, bytearray())
+        l2Area =  BinarySegment(0x1c000000, bytearray())
 
         self.bootBinary.mergedSegments = [l2Area, l1Area]
 
@@ -254,8 +200,7 @@ class FlashImage(object):
             if segment.base > area.base + area.size:
                 diff = segment.base - (area.base + area.size)
                 area.size += diff
-                for i in range(0, diff): 
-                    area.data.append(0)
+                area.data += bytes(diff)
 
             area.data += segment.data
             area.size += segment.size
@@ -274,19 +219,12 @@ class FlashImage(object):
             index += 1
 
         # Then write the header containing memory areas declaration
-        self.__appendInt(l2Area.offset)
-        self.__appendInt(l2Area.base)
-        self.__appendInt(l2Area.size)
-        self.__appendInt(l2Area.nbBlocks)
-
-        self.__appendInt(l1Area.offset)
-        self.__appendInt(l1Area.base)
-        self.__appendInt(l1Area.size)
-        self.__appendInt(l1Area.nbBlocks)
+        self.image.appendObject(FLASH_AREA, l2Area)
+        self.image.appendObject(FLASH_AREA, l1Area)
 
         # Finally write the data
         for area in self.bootBinary.mergedSegments:
-            self.__appendBuffer(area.data, pad=True, encrypt=self.encrypt)
+            self.image.appendBuffer(area.data, pad=True)
 
     def __dumpFlashHeader_v2(self):
 
@@ -321,31 +259,23 @@ class FlashImage(object):
         flashOffset = (flashOffset + 7) & ~7
         self.fsOffset = flashOffset
 
-        header_buff = bytes([])
-        header_buff = self.__appendInt(flashOffset, buff=header_buff)
-        header_buff = self.__appendInt(len(self.bootBinary.segments), buff=header_buff)
-        #self.__appendInt(self.bootBinary.entry)
-        header_buff = self.__appendInt(self.bootBinary.entry, buff=header_buff)
-        header_buff = self.__appendInt(self.bootaddr, buff=header_buff)
+        # The header is allocated with its final size, padding and CRC
+        # included, and its fields are then packed in place
+        header_buff = self.image.reserve(crc_offset - self.image.offset + 4)
+        FLASH_HEADER.packInto(header_buff, 0, flashOffset, len(self.bootBinary.segments), self.bootBinary.entry, self.bootaddr)
 
-        for area in self.bootBinary.segments:
-            header_buff = self.__appendInt(area.offset, buff=header_buff)
-            header_buff = self.__appendInt(area.base, buff=header_buff)
-            header_buff = self.__appendInt(area.size, buff=header_buff)
-            header_buff = self.__appendInt(area.nbBlocks, buff=header_buff)
+        for index, area in enumerate(self.bootBinary.segments):
+            FLASH_AREA.packObjectInto(header_buff, FLASH_HEADER.size + index * FLASH_AREA.size, area)
 
-        header_buff = self.__pad(crc_offset - self.flashOffset - len(header_buff), buff=header_buff)
-        crc = self.get_crc(header_buff)
-        header_buff = self.__appendInt(crc, buff=header_buff)
-        self.__appendBuffer(header_buff, encrypt=self.encrypt)
+        image_builder.packCrc(header_buff, len(header_buff) - 4)
 
 
 
         # Finally write the data
         for area in self.bootBinary.segments:
-            self.__appendBuffer(area.data, padToOffset=area.offset, encrypt=self.encrypt)
+            self.image.appendBuffer(area.data, padToOffset=area.offset)
 
-        self.__pad(self.fsOffset - self.flashOffset)
+        self.image.padToOffset(self.fsOffset)
 
 
     def __dumpSections(self):
@@ -354,7 +284,7 @@ class FlashImage(object):
             print ("  Number of sections: %d" % len(self.bootBinary.segments))
 
         for area in self.bootBinary.segments:
-            self.__appendSection(area.data, encrypt=self.encrypt)
+            self.__appendSection(area.data)
 
     def __createSysDescr(self):
         if self.verbose:
@@ -362,17 +292,15 @@ class FlashImage(object):
             print ("  Number of chips: %d" % self.sysNumChips)
 
         self.buffSysDescr += struct.pack("I",self.sysNumChips)
-        for i in range(12): self.buffSysDescr.append(0)
+        self.buffSysDescr += bytes(12)
         for chipIdx in range(self.sysNumChips):
             self.buffSysDescr += struct.pack("I",self.sysChipID[chipIdx])
             self.buffSysDescr += struct.pack("I",self.sysNumBins[chipIdx])
             for binPtr in range(self.sysNumBins[chipIdx]):
                 self.buffSysDescr += struct.pack("I",self.sysBinPtrs[chipIdx][binPtr])
-            for i in range(4*(self.sysMaxBins-self.sysNumBins[chipIdx])):
-                self.buffSysDescr.append(0)
+            self.buffSysDescr += bytes(4*(self.sysMaxBins-self.sysNumBins[chipIdx]))
         # pad to full page
-        for i in range(self.blockSize-len(self.buffSysDescr)):
-            self.buffSysDescr.append(0)
+        self.buffSysDescr += bytes(max(self.blockSize-len(self.buffSysDescr), 0))
 
 
     def __createBinDescr(self):
@@ -383,33 +311,26 @@ class FlashImage(object):
         if len(self.bootBinary.segments) > self.binMaxSect:
             raise Exception('Too many (%d) sections in binary, currently only max. %d supported.' % (len(self.bootBinary.segments), self.binMaxSect)) 
 
-        tempBuff = []
-        tempBuff += struct.pack("I",len(self.bootBinary.segments))
-        tempBuff += struct.pack("I",self.bootBinary.entry)
-        tempBuff += struct.pack("I",self.bootaddr)
+        tempBuff = bytearray(BIN_DESCR_HEADER.pack(len(self.bootBinary.segments), self.bootBinary.entry, self.bootaddr))
 
         flashAddr = self.binFlashAddr
         index = 0
         for segment in self.bootBinary.segments:
             segment.nbBlocks = int((segment.size + self.blockSize - 1) / self.blockSize) # TODO this looks like a creative ceil function, check
             # actual print of section info
-            tempBuff += struct.pack("I",flashAddr)
-            tempBuff += struct.pack("I",segment.base)
-            tempBuff += struct.pack("I",segment.size)
-            tempBuff += struct.pack("I",segment.nbBlocks)
+            tempBuff += BIN_DESCR_SECTION.pack(flashAddr, segment.base, segment.size, segment.nbBlocks)
 
             if self.verbose: print ("  Section %d: flash addr: 0x%x, chip address: 0x%x, size: 0x%x, nbBlocks: %d" % (index, flashAddr, segment.base, segment.size, segment.nbBlocks))
             flashAddr += segment.nbBlocks * self.blockSize
             index += 1
 
-        checksum = 0
-        for value in tempBuff: checksum += bin(value).count("1")
+        # The checksum is the number of bits set in the descriptor
+        checksum = sum(tempBuff.translate(POPCOUNT_TABLE))
 
         self.buffBinDescr += struct.pack("I",checksum)
         self.buffBinDescr += tempBuff
         # pad to full page
-        for i in range(self.blockSize-len(self.buffBinDescr)):
-            self.buffBinDescr.append(0)
+        self.buffBinDescr += bytes(max(self.blockSize-len(self.buffBinDescr), 0))
 
 
     def __dumpBootBinaryToBuff(self):
@@ -417,12 +338,14 @@ class FlashImage(object):
 
             if self.archi == 'vivosoc2' or self.archi == 'fulmine':
                 self.__dumpFlashHeader_v1()
+                self.bootAreas = self.bootBinary.mergedSegments
             else:
                 self.__dumpFlashHeader_v2()
+                self.bootAreas = self.bootBinary.segments
 
         else:
             # In case no boot binary is there, we must have at least the first word telling where starts the next descriptor
-            self.__appendLongInt(8)
+            self.image.appendLongInt(8)
 
 
     def __dumpCompsToBuff(self):
@@ -431,9 +354,12 @@ class FlashImage(object):
         #  Flash address computation
         #
         
-        if self.verbose: print ('Generating files (header offset: 0x%x)' % self.flashOffset)
+        self.compsOffset = self.image.offset
+        self.flashComps = self.compList
 
-        flashAddr = self.flashOffset
+        if self.verbose: print ('Generating files (header offset: 0x%x)' % self.image.offset)
+
+        flashAddr = self.image.offset
         headerSize = 0
         
         # Compute the header size
@@ -445,8 +371,21 @@ class FlashImage(object):
         
         flashAddr += headerSize
         
-        # Now set the flash address for each component
-        for comp in self.compList:
+        # Now set the flash address for each component, components with the
+        # same content as a previous one can share its flash data
+        if self.dedup:
+            sameComps = flash_layout.getSameComps(self.compList)
+        else:
+            sameComps = [None] * len(self.compList)
+
+        for comp, sameComp in zip(self.compList, sameComps):
+            if sameComp is not None:
+                comp.flashAddr = sameComp.flashAddr
+                comp.stored = False
+                if self.verbose:
+                    print ('  Adding component (name: %s, flashOffset: 0x%x, same as: %s)' % (comp.name, comp.flashAddr, sameComp.name))
+                continue
+
             comp.flashAddr = (flashAddr + 3) & ~3
             if self. verbose:
                 print ('  Adding component (name: %s, flashOffset: 0x%x)' % (comp.name, comp.flashAddr))
@@ -456,38 +395,54 @@ class FlashImage(object):
         # Now create the raw image as a byte array
         
         # First header size
-        self.__appendLongInt(headerSize)
+        self.image.appendLongInt(headerSize)
         
         # Number of components
-        self.__appendInt(len(self.compList))
+        self.image.appendInt(len(self.compList))
         
         # Then for each component
         for comp in self.compList:
             # The flash address
-            self.__appendInt(comp.flashAddr)
+            self.image.appendInt(comp.flashAddr)
         
             # Binary size
-            self.__appendInt(comp.size)
+            self.image.appendInt(comp.size)
         
             # The path length
-            self.__appendInt(len(comp.name)+1)
+            self.image.appendInt(len(comp.name)+1)
         
             # And the path
-            self.__appendBuffer(comp.name.encode('utf-8'))
-            self.__appendByte(0)
+            self.image.appendBuffer(comp.name.encode('utf-8'))
+            self.image.appendByte(0)
         
         # Then dump all components
         for comp in self.compList:
-            with open(comp.path, 'rb') as file:
-                self.__appendBuffer(file.read(), padToOffset=comp.flashAddr)
+            if comp.stored:
+                self.image.appendFile(comp.path, comp.size, padToOffset=comp.flashAddr)
 
 
 
+    def plan(self):
+        # NAND images are made of sections described by the system and binary
+        # descriptors instead of the boot header
+        if self.flashType == 'nand':
+            raise Exception('Flash layout can not be planned for NAND flash images')
+        return flash_layout.planFlashImage(self)
+
+    def get_info(self):
+        return FlashImageInfo(self)
+
     def generate(self):
 
 
         if self.flashType != 'nand':
             self.__dumpToBuff()
+            self.size = self.image.get_size()
+
+        # Assemble the image in memory only if the stimuli needs it, the raw
+        # image can then be written from the assembled buffer
+        if self.stimuli != None:
+            buff = self.image.get_buffer()
 
         # raw binary, aligned to flash page boundaries
         if self.raw != None:
@@ -502,7 +457,7 @@ class FlashImage(object):
                     file.write(bytes(self.buffSect))
             else:
                 with open(self.raw, 'wb') as file:
-                    file.write(bytes(self.buff))
+                    self.image.write(file)
 
         if self.archi == 'vivosoc3' or self.archi == 'vivosoc3_1':
             # system descriptor
@@ -527,79 +482,57 @@ class FlashImage(object):
 
             with open(self.stimuli, 'w') as file:
                 if self.flashType == 'mram':
-                    last_bytes = len(self.buff) & 0x7
-                    for i in range(0, 8 - last_bytes):
-                        self.__appendByte(0)
-                    for i in range(0, len(self.buff)>>3):
-                        value = (self.buff[i*8+7] << 56) + (self.buff[i*8+6] << 48) + (self.buff[i*8+5] << 40) + (self.buff[i*8+4] << 32) + (self.buff[i*8+3] << 24) + (self.buff[i*8+2] << 16) + (self.buff[i*8+1] << 8) + self.buff[i*8]
-                        dumpLongToSlm(file, i, value)
+                    last_bytes = len(buff) & 0x7
+                    buff += bytes(8 - last_bytes)
+                    slm_utils.dumpLongsToSlm(file, 0, buff)
                 elif self.flashType == 'hyper':
-                    if len(self.buff) & 1 != 0:
-                        self.__appendByte(0)
-                    for i in range(0, len(self.buff)>>1):
-                        value = (self.buff[i*2+1] << 8) + self.buff[i*2]
-                        dumpShortToSlm(file, i, value)
+                    if len(buff) & 1 != 0:
+                        buff += bytes(1)
+                    slm_utils.dumpShortsToSlm(file, 0, buff)
                 elif self.archi == 'vivosoc2' or self.archi == 'fulmine':
-                    if len(self.buff) % 4 != 0:
-                        for i in range(0, 4 - (len(self.buff)%4)):
-                            self.buff.append(0)
-                    for i in range(0, len(self.buff), 4):
-                        dumpByteToSlm(file, i, self.buff[i+3])
-                        dumpByteToSlm(file, i+1, self.buff[i+2])
-                        dumpByteToSlm(file, i+2, self.buff[i+1])
-                        dumpByteToSlm(file, i+3, self.buff[i+0])
+                    if len(buff) % 4 != 0:
+                        buff += bytes(4 - (len(buff)%4))
+                    swapped = bytearray(len(buff))
+                    for i in range(0, 4):
+                        swapped[i::4] = buff[3-i::4]
+                    slm_utils.dumpBytesToSlm(file, 0, swapped)
                 elif self.flashType == 'nand':
                     nand_model_stretch_fact = 4
 
-                    for i in range(0, len(self.buffSysDescr)):
-                        dumpByteToSlm(file, i, self.buffSysDescr[i])
+                    slm_utils.dumpBytesToSlm(file, 0, self.buffSysDescr)
 
-                    for i in range(0, len(self.buffBinDescr)):
-                        dumpByteToSlm(file, i+nand_model_stretch_fact*self.sysBinPtrs[1][1], self.buffBinDescr[i])
+                    slm_utils.dumpBytesToSlm(file, nand_model_stretch_fact*self.sysBinPtrs[1][1], self.buffBinDescr)
 
                     
                     nbPages = len(self.buffSect) // self.blockSize
                     for j in range(0, nbPages):
-                        for i in range(0, self.blockSize):
-                            dumpByteToSlm(file, nand_model_stretch_fact*self.binFlashAddr + nand_model_stretch_fact*j*self.blockSize + i, self.buffSect[j*self.blockSize + i])
+                        slm_utils.dumpBytesToSlm(file, nand_model_stretch_fact*self.binFlashAddr + nand_model_stretch_fact*j*self.blockSize, self.buffSect[j*self.blockSize:(j+1)*self.blockSize])
                 else:
-                    for i in range(0, len(self.buff)):
-                        dumpByteToSlm(file, i, self.buff[i])
+                    slm_utils.dumpBytesToSlm(file, 0, buff)
 
 
-def genFlashImage(slmStim=None, rawStim=None, sysDescr=None, binDescr=None, bootBinary=None, comps=[], verbose=False, archi=None, encrypt=False, aesKey=None, aesIv=None, flashType='spi', qpi=True):
-    if bootBinary != None or len(comps) != 0:
-        if slmStim != None or rawStim is not None:
-            compsList = ''
-            romBoot = ''
+def buildFlashImage(slmStim=None, rawStim=None, sysDescr=None, binDescr=None, bootBinary=None, comps=[], verbose=False, archi=None, encrypt=False, aesKey=None, aesIv=None, flashType='spi', qpi=True, dedup=False):
+    if verbose:
+        print ('Building flash stimuli (stimuli: %s, raw: %s)' % (slmStim, rawStim))
 
-            if bootBinary != None:
-                romBoot = ' --flash-boot-binary=%s' % bootBinary
-    
-            for comp in comps:
-                compsList += ' --comp=%s' % comp
-    
-            if slmStim is not None:
-                cmd = "plp_mkflash_vivo3 %s %s --stimuli=%s --flash-type=%s" % (romBoot, compsList, slmStim, flashType)
-            else:
-                cmd = "plp_mkflash_vivo3 %s %s --raw=%s --flash-type=%s" % (romBoot, compsList, raw_stim, flashType)
+    # VivoSoC 3+ flash structure related stuff
+    flashImage = FlashImage(raw=rawStim, sysDescr=sysDescr, binDescr=binDescr, stimuli=slmStim, verbose=verbose, archi=archi, encrypt=encrypt, aesKey=aesKey, aesIv=aesIv, flashType=flashType, qpi=qpi, dedup=dedup)
+
+    if bootBinary is not None:
+        flashImage.appendBootBinary(elf=bootBinary)
 
-            # VivoSoC 3+ flash structure related stuff
-            if rawStim   != None: cmd += ' --raw=%s'      % rawStim
-            if sysDescr  != None: cmd += ' --sysDescr=%s' % sysDescr
-            if binDescr  != None: cmd += ' --binDescr=%s' % binDescr
+    for comp in comps:
+        flashImage.appendComponent(os.path.dirname(comp), os.path.basename(comp))
 
-            if qpi: cmd+= ' --qpi'
+    flashImage.generate()
 
-            if encrypt: cmd += ' --encrypt --aes-key=%s --aes-iv=%s' % (aesKey, aesIv)
+    return flashImage.get_info()
 
-            if verbose: cmd += ' --verbose'
-            if archi != None: cmd += ' --archi=%s' % archi
-            if verbose:
-                print ('Building flash stimuli with command:')
-                print (cmd)
-            if os.system(cmd) != 0:
-                raise Exception('Error while generating flash image')
 
+# Used by the runners, which only need an image if there is something to boot
+# from the flash and somewhere to put it
+def genFlashImage(slmStim=None, rawStim=None, sysDescr=None, binDescr=None, bootBinary=None, comps=[], verbose=False, archi=None, encrypt=False, aesKey=None, aesIv=None, flashType='spi', qpi=True, dedup=False):
+    if bootBinary is None and len(comps) == 0 or slmStim is None and rawStim is None:
+        return None
 
-    return 0
+    return buildFlashImage(slmStim=slmStim, rawStim=rawStim, sysDescr=sysDescr, binDescr=binDescr, bootBinary=bootBinary, comps=comps, verbose=verbose, archi=archi, encrypt=encrypt, aesKey=aesKey, aesIv=aesIv, flashType=flashType, qpi=qpi, dedup=dedup)
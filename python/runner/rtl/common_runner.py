@@ -60,6 +60,12 @@ class Runner(Platform):
         parser.add_argument("--vsim-dofile", dest="vsim_dofile", default=None, help="Specify vsim do file")
 
         parser.add_argument("--vsim-model", dest="vsim_model", default="sverilog", help="Specify platform model used")
+
+        parser.add_argument("--stim-explicit-zeros", dest="stim_explicit_zeros",
+                            action="store_true", help='Explicitly initialize BSS sections to 0 in preload stimuli')
+
+        parser.add_argument("--stim-jobs", dest="stim_jobs", type=int, default=1,
+                            help='Number of processes used to parse binaries when generating preload stimuli')
                         
         [args, otherArgs] = parser.parse_known_args()
 
@@ -69,28 +75,28 @@ class Runner(Platform):
 
         # Overwrite JSON configuration with specific options
         if args.gui:
-            js_config.get('**/vsim').set('gui', True)
+            self.get_json().get('**/vsim').set('gui', True)
 
         if args.vsim_recordwlf:
-            js_config.get('**/vsim').set('recordwlf', True)
+            self.get_json().get('**/vsim').set('recordwlf', True)
 
         if args.vsim_enablecov:
-            js_config.get('**/vsim').set('enablecov', True)
+            self.get_json().get('**/vsim').set('enablecov', True)
 
         if args.vsim_dofile is not None:
-            js_config.get('**/vsim').set('dofile', args.vsim_dofile)
+            self.get_json().get('**/vsim').set('dofile', args.vsim_dofile)
 
-        js_config.get('**/vsim').set('vsim_model', args.vsim_model)
+        self.get_json().get('**/vsim').set('vsim_model', args.vsim_model)
 
 
         binary = self.config.getOption('binary')
         if binary is not None:
-            js_config.get('**/runner').set('binary', binary)
+            self.get_json().get('**/runner').set('binary', binary)
 
         if args.boot_from_flash:
-            js_config.get('**/runner').set('boot_from_flash', True)
+            self.get_json().get('**/runner').set('boot_from_flash', True)
 
-        self.stim = runner.stim_utils.stim(verbose=self.get_json().get('**/runner/verbose').get())
+        self.stim = runner.stim_utils.stim(verbose=self.get_json().get('**/runner/verbose').get(), explicit_zeros=args.stim_explicit_zeros, jobs=args.stim_jobs)
 
         for binary in self.get_json().get('**/runner/binaries').get_dict():
             self.stim.add_binary(binary)
@@ -174,7 +180,7 @@ class Runner(Platform):
             aes_key = self.get_json().get_child_str('**/efuse/aes_key')
             aes_iv = self.get_json().get_child_str('**/efuse/aes_iv')
 
-            if plp_flash_stimuli_vivo3.genFlashImage(
+            plp_flash_stimuli_vivo3.genFlashImage(
                 slmStim=self.get_json().get('**/runner/flash_slm_file').get(),
                 rawStim=self.get_json().get('**/runner/flash_raw_file').get(),
                 binDescr=self.get_json().get('**/runner/flash_binDescr_file').get(),
@@ -184,8 +190,7 @@ class Runner(Platform):
                 verbose=self.get_json().get('**/runner/verbose').get(),
                 archi=self.get_json().get('**/pulp_chip_family').get(),
                 flashType=self.get_json().get('**/runner/flash_type').get(),
-                encrypt=encrypted, aesKey=aes_key, aesIv=aes_iv):
-                return -1
+                encrypt=encrypted, aesKey=aes_key, aesIv=aes_iv)
     
             if not self.get_json().get('**/runner/boot_from_flash').get():
 
@@ -211,15 +216,14 @@ class Runner(Platform):
                 aes_key = self.get_json().get_child_str('**/efuse/aes_key')
                 aes_iv = self.get_json().get_child_str('**/efuse/aes_iv')
 
-                if plp_flash_stimuli.genFlashImage(
+                plp_flash_stimuli.genFlashImage(
                     slmStim=self.get_json().get('**/runner/flash_slm_file').get(),
                     bootBinary=self.get_json().get('**/runner/binaries').get_elem(0).get(),
                     comps=comps,
                     verbose=self.get_json().get('**/runner/verbose').get(),
                     archi=self.get_json().get('**/pulp_chip_family').get(),
                     flashType=self.get_json().get('**/runner/flash_type').get(),
-                    encrypt=encrypted, aesKey=aes_key, aesIv=aes_iv):
-                    return -1
+                    encrypt=encrypted, aesKey=aes_key, aesIv=aes_iv)
 
             else:
 
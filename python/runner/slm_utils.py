@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+# Dump of whole buffers to SLM stimuli, shared by the flash image builders.
+#
+# The buffer is cut into little-endian values which are all converted to
+# hexadecimal at once, then lines are generated 256 at a time, as they share
+# the same address prefix, by formatting a single template.
+
+
+
+# Number of lines written to the file at once
+SLM_CHUNK_SIZE = 64
+
+def dumpValuesToSlm(file, addr, buff, width):
+    size = len(buff) - len(buff) % width
+    if size == 0:
+        return
+
+    # Values are printed MSB first
+    data = bytearray(size)
+    for i in range(0, width):
+        data[i::width] = buff[width-1-i:size:width]
+    values = data.hex(' ', width).upper().split(' ')
+
+    template = ''.join(['@#%02X %%s\n' % i for i in range(0, 256)])
+    lineSize = len(template) // 256
+
+    lines = []
+    index = 0
+    while index < len(values):
+        lineAddr = addr + index
+        low = lineAddr & 0xff
+        count = min(256 - low, len(values) - index)
+        lines.append(template[low*lineSize:(low+count)*lineSize].replace('#', '%06X' % (lineAddr >> 8)) % tuple(values[index:index+count]))
+        index += count
+        if len(lines) == SLM_CHUNK_SIZE:
+            file.write(''.join(lines))
+            lines = []
+
+    file.write(''.join(lines))
+
+def dumpBytesToSlm(file, addr, buff):
+    dumpValuesToSlm(file, addr, buff, 1)
+
+def dumpShortsToSlm(file, addr, buff):
+    dumpValuesToSlm(file, addr, buff, 2)
+
+def dumpLongsToSlm(file, addr, buff):
+    dumpValuesToSlm(file, addr, buff, 8)
@@ -20,29 +20,323 @@
 # Authors: Germain Haugou, ETH (germain.haugou@iis.ee.ethz.ch)
 #
 
-from elftools.elf.elffile import ELFFile
+import runner.elf_loader as elf_loader
 import os
 import os.path
 import struct
 import argparse
+import bisect
+import heapq
+import multiprocessing
+
+
+
+class MemImage(object):
+
+  # Memory image stored as a list of contiguous extents sorted by address.
+  # Each extent is a [base, bytearray] pair, and extents never overlap nor
+  # touch each other, adjacent data is merged into the same extent.
+  # Areas initialized to zero, like BSS sections, are only recorded as
+  # sorted [base, size] pairs, and are materialized only when an output
+  # needs them. Data extents always take precedence over these areas.
+
+  def __init__(self):
+    self.extents = []
+    self.bases = []
+    self.zeros = []
+
+  def add(self, base, data):
+
+    size = len(data)
+    if size == 0:
+      return
+
+    end = base + size
+
+    # Find the range of extents overlapping or touching the new data
+    first = bisect.bisect_left(self.bases, base)
+    if first > 0:
+      prev_base, prev_data = self.extents[first-1]
+      if prev_base + len(prev_data) >= base:
+        first -= 1
+    last = bisect.bisect_right(self.bases, end)
+
+    if first == last:
+      self.extents.insert(first, [base, bytearray(data)])
+      self.bases.insert(first, base)
+      return
+
+    first_base, first_data = self.extents[first]
+    last_base, last_data = self.extents[last-1]
+    last_end = last_base + len(last_data)
+
+    # Fast path, the new data is fully inside an existing extent
+    if first == last - 1 and first_base <= base and end <= last_end:
+      first_data[base-first_base:end-first_base] = data
+      return
+
+    suffix = last_data[end-last_base:] if last_end > end else b''
+
+    if first_base <= base:
+      new_base = first_base
+      new_data = first_data
+      new_data[base-first_base:] = data
+    else:
+      new_base = base
+      new_data = bytearray(data)
+
+    new_data += suffix
+
+    self.extents[first:last] = [[new_base, new_data]]
+    self.bases[first:last] = [new_base]
+
+  def add_zeros(self, base, size):
+
+    if size == 0:
+      return
+
+    end = base + size
+
+    # Data previously written to this area must be cleared
+    index = max(bisect.bisect_right(self.bases, base) - 1, 0)
+    while index < len(self.extents) and self.extents[index][0] < end:
+      ext_base, data = self.extents[index]
+      start = max(base, ext_base)
+      stop = min(end, ext_base + len(data))
+      if start < stop:
+        data[start-ext_base:stop-ext_base] = bytes(stop - start)
+      index += 1
+
+    # And the area is merged with the overlapping or touching ones
+    first = bisect.bisect_left(self.zeros, [base])
+    if first > 0 and sum(self.zeros[first-1]) >= base:
+      first -= 1
+    last = bisect.bisect_right(self.zeros, [end + 1])
+
+    if first < last:
+      base = min(base, self.zeros[first][0])
+      end = max(end, sum(self.zeros[last-1]))
+
+    self.zeros[first:last] = [[base, end - base]]
+
+  def get_zero_extents(self):
+
+    # Return the parts of the zero areas which are not covered by data
+    for base, size in self.zeros:
+      end = base + size
+      index = max(bisect.bisect_right(self.bases, base) - 1, 0)
+      while index < len(self.extents) and base < end:
+        ext_base, data = self.extents[index]
+        if ext_base >= end:
+          break
+        if ext_base > base:
+          yield base, ext_base - base
+        base = max(base, ext_base + len(data))
+        index += 1
+
+      if base < end:
+        yield base, end - base
+
+  def get_overlaps(self, base, size):
+
+    # Return the parts of the specified area which are already covered by
+    # data or zero areas
+    end = base + size
+    overlaps = []
+
+    index = max(bisect.bisect_right(self.bases, base) - 1, 0)
+    while index < len(self.extents) and self.extents[index][0] < end:
+      ext_base, data = self.extents[index]
+      if ext_base + len(data) > base:
+        overlaps.append([max(base, ext_base), min(end, ext_base + len(data))])
+      index += 1
+
+    index = max(bisect.bisect_right(self.zeros, [base]) - 1, 0)
+    while index < len(self.zeros) and self.zeros[index][0] < end:
+      zero_base, zero_size = self.zeros[index]
+      if zero_base + zero_size > base:
+        overlaps.append([max(base, zero_base), min(end, zero_base + zero_size)])
+      index += 1
+
+    return overlaps
+
+  def merge(self, image):
+
+    # Write the content of another image on top of this one, and return the
+    # areas which were overwritten
+    if len(self.extents) == 0 and len(self.zeros) == 0:
+      self.extents = list(image.extents)
+      self.bases = list(image.bases)
+      self.zeros = [list(zero) for zero in image.zeros]
+      return []
+
+    overlaps = []
+
+    for base, data in image.extents:
+      overlaps += self.get_overlaps(base, len(data))
+      self.add(base, data)
+
+    for base, size in list(image.get_zero_extents()):
+      overlaps += self.get_overlaps(base, size)
+      self.add_zeros(base, size)
+
+    return sorted(overlaps)
+
+  def get_aligned_extents(self, width, zeros=False):
+
+    # Group the extents sharing at least one word of the specified width,
+    # and return them as buffers whose base and size are aligned on it,
+    # so that they can be directly sliced into words.
+    # Zero areas are only included if asked, and then just extend the
+    # groups as the buffers are already initialized to zero.
+    pieces = [[base, len(data), data] for base, data in self.extents]
+    if zeros:
+      pieces = heapq.merge(pieces, [[base, size, None] for base, size in self.get_zero_extents()], key=lambda piece: piece[0])
+
+    groups = []
+    for base, size, data in pieces:
+      start = base & ~(width - 1)
+      end = (base + size + width - 1) & ~(width - 1)
+      if len(groups) != 0 and start < groups[-1][1]:
+        groups[-1][2].append([base, data])
+        groups[-1][1] = max(groups[-1][1], end)
+      else:
+        groups.append([start, end, [[base, data]]])
+
+    for start, end, extents in groups:
+      if len(extents) == 1 and extents[0][0] == start and extents[0][1] is not None and len(extents[0][1]) == end - start:
+        yield start, memoryview(extents[0][1])
+      else:
+        buff = bytearray(end - start)
+        for base, data in extents:
+          if data is not None:
+            buff[base-start:base-start+len(data)] = data
+        yield start, memoryview(buff)
+
+
+
+class AreaIndex(object):
+
+  # Target areas kept as a sorted list of disjoint [start, end] intervals,
+  # overlapping or touching areas being merged together, so that the parts
+  # of a segment covered by the areas can be found by bisection.
+
+  def __init__(self):
+    self.areas = []
+    self.starts = []
+
+  def add(self, start, end):
+    first = bisect.bisect_left(self.starts, start)
+    if first > 0 and self.areas[first-1][1] >= start:
+      first -= 1
+    last = bisect.bisect_right(self.starts, end)
+
+    if first < last:
+      start = min(start, self.areas[first][0])
+      end = max(end, self.areas[last-1][1])
+
+    self.areas[first:last] = [[start, end]]
+    self.starts[first:last] = [start]
+
+  def is_empty(self):
+    return len(self.areas) == 0
+
+  def clip(self, base, end):
+    # Return the sub-ranges of [base, end] covered by the areas
+    ranges = []
+    index = max(bisect.bisect_right(self.starts, base) - 1, 0)
+    while index < len(self.areas) and self.areas[index][0] < end:
+      area_start, area_end = self.areas[index]
+      if area_end > base:
+        ranges.append([max(base, area_start), min(end, area_end)])
+      index += 1
+    return ranges
+
+
+
+def get_holes(base, end, ranges):
+
+  # Return the sub-ranges of [base, end] not covered by the sorted ranges
+  holes = []
+  for start, stop in ranges:
+    if start > base:
+      holes.append([base, start])
+    base = stop
+  if base < end:
+    holes.append([base, end])
+  return holes
+
+
+
+def parse_binary(binary, areas):
+
+  # Parse the loadable segments of a binary into a memory image, and return
+  # it with the messages to be dumped in verbose mode. This is a plain
+  # function so that it can be run in a process pool.
+  # If target areas are specified, segments are clipped to them, so that
+  # only the covered parts are loaded.
+
+  mem = MemImage()
+  logs = []
+
+  for segment in elf_loader.get_elf(binary).segments:
+
+      data = segment.data
+      addr = segment.base
+      size = segment.memsz
+
+      if areas.is_empty():
+        ranges = [[addr, addr + size]]
+      else:
+        ranges = areas.clip(addr, addr + size)
+
+      if len(ranges) == 0:
+        logs.append('  Bypassing section (base: 0x%x, size: 0x%x)' % (addr, size))
+        continue
+
+      logs.append('  Handling section (base: 0x%x, size: 0x%x)' % (addr, size))
+
+      for start, end in get_holes(addr, addr + size, ranges):
+        logs.append('  Dropping section part outside target areas (base: 0x%x, size: 0x%x)' % (start, end - start))
+
+      zero_base = addr + segment.filesz
+
+      for start, end in ranges:
+
+        if start < zero_base:
+          mem.add(start, data[start-addr:min(end, zero_base)-addr])
+
+        if end > zero_base:
+          start = max(start, zero_base)
+          logs.append('  Init section to 0 (base: 0x%x, size: 0x%x)' % (start, end - start))
+          mem.add_zeros(start, end - start)
+
+  return mem, logs
 
 
 
 class stim(object):
 
 
-  def __init__(self, verbose=False):
+  def __init__(self, verbose=False, explicit_zeros=False, jobs=1, overlap='warning'):
     self.binaries = []
-    self.mem = {}
+    self.mem = MemImage()
+    self.parsed = False
     self.verbose = verbose
-    self.areas = []
+    self.areas = AreaIndex()
+    # BSS sections are only written to SLM stimuli if this is set, as most
+    # testbenches do not need to preload them
+    self.explicit_zeros = explicit_zeros
+    # Binaries are parsed in a pool of processes if more than 1 job is
+    # specified. Overlaps between binaries are either reported as warnings
+    # or raised as errors.
+    self.jobs = jobs
+    self.overlap = overlap
 
     self.dump('Created stimuli generator')
 
   def get_entry(self):
-    with open(self.binaries[0], 'rb') as file:
-        elffile = ELFFile(file)
-        return elffile.header['e_entry']
+    return elf_loader.get_elf(self.binaries[0]).entry
 
   def dump(self, str):
     if self.verbose:
@@ -51,131 +345,575 @@ class stim(object):
   def add_binary(self, binary):
     self.dump('  Added binary: %s' % binary)
     self.binaries.append(binary)
+    self.parsed = False
 
   def add_area(self, start, size):
     self.dump('  Added target area: [0x%x -> 0x%x]' % (start, start + size))
-    self.areas.append([start, start+size])
+    self.areas.add(start, start+size)
+    self.parsed = False
 
 
-  def __add_mem_word(self, base, size, data, width):
+  def __create_dir(self, filename):
+    try:
+      os.makedirs(os.path.dirname(filename))
+    except:
+      pass
 
-    aligned_base = base & ~(width - 1)
+  def __get_hex_blocks(self, width):
 
-    shift = base - aligned_base
-    iter_size = width - shift
-    if iter_size > size:
-      iter_size = size
+    # The image is dumped by blocks of words, each block being byte-swapped
+    # and hex-encoded at once, to avoid doing it word by word.
+    # Each block is returned with its address and the list of words.
 
-    value = self.mem.get(str(aligned_base))
-    if value is None:
-      value = 0
+    for addr, chunk in self.iter_chunks((1 << 16) * width, width):
+      block = bytes(chunk)
+      swapped = bytearray(len(block))
+      for i in range(0, width):
+        swapped[i::width] = block[width-1-i::width]
 
-    value &= ~(((1<<width) - 1) << (shift*8))
-    value |= int.from_bytes(data[0:iter_size], byteorder='little') << (shift*8)
+      yield addr, swapped.hex(' ', width).upper().split(' ')
 
-    self.mem[str(aligned_base)] = value
+  def __gen_stim_slm(self, filename, width):
 
-    return iter_size
+    self.dump('  Generating to file: %s (format: slm, width: %d)' % (filename, width))
 
+    self.__create_dir(filename)
 
+    with open(filename, 'w') as file:
+      for addr, words in self.__get_hex_blocks(width):
+        addrs = range(addr, addr + len(words) * width, width)
+        file.write('\n'.join(['%X_%s' % line for line in zip(addrs, words)]))
+        file.write('\n')
 
+  def __gen_stim_readmemh(self, filename, width):
 
+    # Words are addressed by their index, an address directive being
+    # written at the beginning of each contiguous area
 
-  def __add_mem(self, base, size, data, width):
+    self.dump('  Generating to file: %s (format: readmemh, width: %d)' % (filename, width))
 
-    while size > 0:
+    self.__create_dir(filename)
 
-      iter_size = self.__add_mem_word(base, size, data, width)
+    with open(filename, 'w') as file:
+      next_addr = None
+      for addr, words in self.__get_hex_blocks(width):
+        if addr != next_addr:
+          file.write('@%X\n' % (addr // width))
+        next_addr = addr + len(words) * width
+        file.write('\n'.join(words))
+        file.write('\n')
 
-      size -= iter_size
-      base += iter_size
-      data = data[iter_size:]
+  def __gen_stim_bin(self, filename, base=None):
 
+    # The binary file starts at the specified base address, or at the lowest
+    # address of the image if none is specified. Holes between extents are
+    # not written but skipped with seek so that they end up as sparse holes
+    # filled with zeros. Zero areas are handled the same way, they just
+    # extend the file.
 
-  def __gen_stim_slm(self, filename, width):
+    extents = self.mem.extents
+    zeros = self.mem.zeros
 
-    self.dump('  Generating to file: ' + filename)
+    ranges = [[addr, addr + len(data)] for addr, data in extents[0:1] + extents[-1:]]
+    ranges += [[addr, addr + size] for addr, size in zeros[0:1] + zeros[-1:]]
 
-    try:
-      os.makedirs(os.path.dirname(filename))
-    except:
-      pass
+    start = min([r[0] for r in ranges], default=0)
+    end = max([r[1] for r in ranges], default=0)
 
-    with open(filename, 'w') as file:
-      for key in sorted(self.mem.keys()):
-        file.write('%X_%0*X\n' % (int(key), width*2, self.mem.get(key)))
+    if base is None:
+      base = start
+
+    if start < base:
+      raise Exception('Binary data at 0x%x is below the stimuli base address 0x%x' % (start, base))
 
-  def __parse_binaries(self, width):
+    self.dump('  Generating to file: %s (format: bin, base: 0x%x)' % (filename, base))
 
-    self.mem = {}
+    self.__create_dir(filename)
+
+    with open(filename, 'wb') as file:
+      for addr, data in extents:
+        file.seek(addr - base)
+        file.write(data)
+
+      file.truncate(max(end - base, 0))
+
+  def __parse_binaries(self):
+
+    # The image does not depend on the output format, so it is only parsed
+    # again if binaries or areas were added since the last time
+    if self.parsed:
+      return
+
+    if self.jobs > 1 and len(self.binaries) > 1:
+      with multiprocessing.Pool(min(self.jobs, len(self.binaries))) as pool:
+        images = pool.starmap(parse_binary, [(binary, self.areas) for binary in self.binaries])
+    else:
+      images = [parse_binary(binary, self.areas) for binary in self.binaries]
 
-    for binary in self.binaries:
+    self.mem = MemImage()
 
-        with open(binary, 'rb') as file:
-            elffile = ELFFile(file)
+    for binary, (mem, logs) in zip(self.binaries, images):
 
-            for segment in elffile.iter_segments():
+      self.dump('  Loading binary: %s' % binary)
+      for log in logs:
+        self.dump(log)
 
-                if segment['p_type'] == 'PT_LOAD':
+      for base, end in self.mem.merge(mem):
+        msg = 'Binary %s overwrites previous binaries (base: 0x%x, size: 0x%x)' % (binary, base, end - base)
+        if self.overlap == 'error':
+          raise Exception(msg)
+        print ('WARNING: ' + msg)
 
-                    data = segment.data()
-                    addr = segment['p_paddr']
-                    size = len(data)
+    self.parsed = True
 
-                    load = True
-                    if len(self.areas) != 0:
-                      load = False
-                      for area in self.areas:
-                        if addr >= area[0] and addr + size <= area[1]:
-                          load = True
-                          break
 
-                    if load:
+  def iter_chunks(self, chunk_size=None, width=1):
 
-                      self.dump('  Handling section (base: 0x%x, size: 0x%x)' % (addr, size))
+    # Iterate over the image as (address, memoryview) pairs, without any
+    # intermediate file. Chunks are aligned on the specified word width and
+    # are at most chunk_size bytes, or as big as contiguous areas if no size
+    # is specified. Chunks are views on the image, they are only valid until
+    # binaries or areas are modified.
 
-                      self.__add_mem(addr, size, data, width)
+    if width <= 0 or width & (width - 1) != 0:
+      raise Exception('Stimuli word width must be a power of 2, got %d' % width)
 
-                      if segment['p_filesz'] < segment['p_memsz']:
-                          addr = segment['p_paddr'] + segment['p_filesz']
-                          size = segment['p_memsz'] - segment['p_filesz']
-                          self.dump('  Init section to 0 (base: 0x%x, size: 0x%x)' % (addr, size))
-                          self.__add_mem(addr, size, [0] * size, width)
+    if chunk_size is not None and (chunk_size <= 0 or chunk_size % width != 0):
+      raise Exception('Stimuli chunk size must be a multiple of the word width, got %d' % chunk_size)
 
-                    else:
+    self.__parse_binaries()
 
-                      self.dump('  Bypassing section (base: 0x%x, size: 0x%x)' % (addr, size))
+    for base, data in self.mem.get_aligned_extents(width, zeros=self.explicit_zeros):
+      if chunk_size is None:
+        yield base, data
+      else:
+        for offset in range(0, len(data), chunk_size):
+          yield base + offset, data[offset:offset+chunk_size]
 
+  def iter_words(self, width=8):
 
+    # Iterate over the image as (address, value) pairs, each value being a
+    # little-endian word of the specified width in bytes
+    word_format = {1: '<B', 2: '<H', 4: '<I', 8: '<Q'}.get(width)
+
+    for base, data in self.iter_chunks((1 << 16) * width, width):
+      if word_format is not None:
+        for index, value in enumerate(struct.iter_unpack(word_format, data)):
+          yield base + index * width, value[0]
+      else:
+        for offset in range(0, len(data), width):
+          yield base + offset, int.from_bytes(data[offset:offset+width], byteorder='little')
+
+
+  def generate(self, outputs):
+
+    # Generate several stimuli files from a single parsing of the binaries.
+    # Each output is a dictionary with the following keys:
+    #   format: 'slm', 'readmemh' or 'bin'
+    #   file:   path of the file to be generated
+    #   width:  word width in bytes for slm and readmemh (default: 8)
+    #   base:   base address of the bin file (default: lowest address)
+
+    self.__parse_binaries()
+
+    for output in outputs:
+      format = output.get('format')
+      filename = output.get('file')
+
+      if format == 'slm':
+        self.__gen_stim_slm(filename, output.get('width', 8))
+      elif format == 'readmemh':
+        self.__gen_stim_readmemh(filename, output.get('width', 8))
+      elif format == 'bin':
+        self.__gen_stim_bin(filename, output.get('base'))
+      else:
+        raise Exception('Unknown stimuli format: ' + str(format))
 
 
   def gen_stim_slm_64(self, stim_file):
 
-    self.__parse_binaries(8)
+    self.generate([{'format': 'slm', 'file': stim_file, 'width': 8}])
+
+
+  def gen_stim_bin(self, stim_file, base=None):
+
+    self.generate([{'format': 'bin', 'file': stim_file, 'base': base}])
+
+
+
+# Efuse registers shared by the boot ROMs of the GAP family
+EFUSE_BOOT_MODE = 0
+EFUSE_INFO2 = 1
+EFUSE_AES_KEY = 2
+EFUSE_AES_IV = 18
+EFUSE_INFO3 = 37
+EFUSE_INFO4 = 38
+EFUSE_INFO5 = 39
+EFUSE_INFO6 = 40
+EFUSE_INFO7 = 60
+
+# RTL platform | flash boot | no encryption | no wait xtal
+EFUSE_ROM_FLASH_BOOT = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
+
+# Configuration parameters which can be used by efuse layouts, with their
+# path in the configuration, their type, and an optional scale factor for
+# ratios stored as fixed-point numbers
+EFUSE_PARAMS = {
+  'load_mode':          ('**/runner/boot-mode', 'str'),
+  'encrypted':          ('**/efuse/encrypted', 'str'),
+  'aes_key':            ('**/efuse/aes_key', 'str'),
+  'aes_iv':             ('**/efuse/aes_iv', 'str'),
+  'xtal_check':         ('**/efuse/xtal_check', 'bool'),
+  'xtal_check_delta':   ('**/efuse/xtal_check_delta', 'bool', (1 << 15) - 1),
+  'xtal_check_min':     ('**/efuse/xtal_check_min', 'bool'),
+  'xtal_check_max':     ('**/efuse/xtal_check_max', 'bool'),
+  'no_preload':         ('**/efuse/no-preload', 'str'),
+  'clk_div':            ('**/efuse/clkdiv', 'int'),
+  'fll_freq':           ('**/efuse/fll/freq', 'int'),
+  'fll_assert_cycles':  ('**/efuse/fll/assert_cycles', 'int'),
+  'fll_lock_tolerance': ('**/efuse/fll/lock_tolerance', 'int'),
+  'hyper_delay':        ('**/efuse/hyper/delay', 'int'),
+  'hyper_latency':      ('**/efuse/hyper/latency', 'int'),
+  'ref_clk_wait':       ('**/efuse/ref_clk_wait', 'int'),
+  'burst_size':         ('**/efuse/burst_size', 'int'),
+  'flash_id':           ('**/efuse/flash_id', 'bool'),
+  'vsim_model':         ('**/vsim/model', 'str'),
+}
+
+# Efuse layouts are described with the following operations on registers:
+#   ('set', reg, value):         reg = value
+#   ('or', reg, value):          reg |= value
+#   ('field', reg, shift, mask, value):
+#                                reg = (reg & ~(mask << shift)) | (value << shift)
+#   ('boot', value):             boot mode |= value, the boot mode being 0 if
+#                                it was not set by the load mode
+# A value is either a constant, the name of a parameter or a tuple
+# (parameter, right shift, mask).
+#
+# Options are applied in order and are (condition, operations) pairs, the
+# condition being:
+#   None:                        always applied
+#   ('set', [params]):           one of the parameters is not None
+#   ('true', param):             the parameter is true
+#   ('eq', param, value):        the parameter is equal to the value
+
+EFUSE_XTAL_CHECK_V1 = (('true', 'xtal_check'), [
+  ('boot', 1 << 7),
+  ('or', 26, ('xtal_check_delta', 0, 0xff)),
+  ('or', 27, ('xtal_check_delta', 8, 0xff)),
+  ('or', 28, 'xtal_check_min'),
+  ('or', 29, 'xtal_check_max'),
+])
+
+EFUSE_XTAL_CHECK_V2 = (('true', 'xtal_check'), [
+  ('boot', 1 << 7),
+  ('set', 26, ('xtal_check_delta', 0, 0xff)),
+  ('set', 27, ('xtal_check_delta', 8, 0xff)),
+  ('set', 28, ('xtal_check_min', 0, 0xff)),
+  ('set', 29, ('xtal_check_min', 8, 0xff)),
+  ('or', 30, ('xtal_check_max', 0, 0xff)),
+  ('set', 31, ('xtal_check_max', 8, 0xff)),
+])
+
+# Activate MRAM TRIM CFG and fill it with dummy numbers until we get the real
+# one. Also activate clock divider
+EFUSE_MRAM_BOOT = [
+  ('or', EFUSE_INFO3, 2 << 0),
+  ('or', EFUSE_INFO6, (1 << 6) | (1 << 7)),
+  ('or', EFUSE_INFO2, 2 << 3),
+  ('set', 56, 32 * 4),
+] + [('set', 57 + i, i | ((i*4+1) << 8) | ((i*4+2) << 16) | ((i*4+3) << 24)) for i in range(0, 32)]
+
+EFUSE_VEGA_OPTIONS = [
+  (('set', ['clk_div']), [('or', EFUSE_INFO6, 1 << 7), ('field', EFUSE_INFO2, 3, 3, 'clk_div')]),
+  (('set', ['fll_freq']), [('or', EFUSE_INFO2, (1 << 0) | (1 << 2)), ('set', 31, 'fll_freq')]),
+  (('set', ['fll_lock_tolerance', 'fll_assert_cycles']), [('or', EFUSE_INFO2, 1 << 1), ('set', 32, 'fll_lock_tolerance'), ('set', 33, 'fll_assert_cycles')]),
+  (('set', ['hyper_delay']), [('or', EFUSE_INFO5, 1 << 6), ('set', 30, 'hyper_delay')]),
+  (('set', ['hyper_latency']), [('or', EFUSE_INFO5, 1 << 7), ('set', 51, 'hyper_latency')]),
+]
+
+# Efuse layout of each chip:
+#   regs:       'list' if the efuses are a list of register values ORed
+#               together, 'array' if they are an array of 128 registers
+#   user:       how the user efuse values (**/efuse/values) are taken into
+#               account: 'or', 'override' or None if they are ignored
+#   output:     'bits' for the bit file (bit N of register R is written at
+#               index R + N*128), 'words' for one 32-bit binary word per line
+#   load_modes: boot mode value and additional operations of each load mode
+#   options:    options applied after the load mode
+#   encryption: operations applied when the image is encrypted, in addition
+#               to the boot mode flag and the AES key and IV registers
+#   defaults:   parameters default values
+EFUSE_LAYOUTS = {
+  'gap': {
+    'regs': 'list', 'user': 'or', 'output': 'bits',
+    'load_modes': {
+      'rom':             (0x3A, []),
+      'spi':             (0x0A, []),
+      'jtag':            (0x12, []),
+      'rom_hyper':       (0x2A, []),
+      'rom_spim_single': (0x32, []),
+      'rom_spim':        (0x3A, []),
+    },
+    'options': [EFUSE_XTAL_CHECK_V1],
+    'encryption': [],
+  },
+
+  'gap_rev1': {
+    'regs': 'list', 'user': 'or', 'output': 'bits',
+    'load_modes': {
+      'rom':       (EFUSE_ROM_FLASH_BOOT, []),
+      # Hyperflash type
+      'rom_hyper': (EFUSE_ROM_FLASH_BOOT, [('or', EFUSE_INFO3, 1 << 0)]),
+      'rom_spim':  (EFUSE_ROM_FLASH_BOOT, []),
+    },
+    'options': [EFUSE_XTAL_CHECK_V1],
+    'encryption': [('or', EFUSE_INFO6, 1 << 4)],
+  },
+
+  'gap8_revc': {
+    'regs': 'array', 'user': 'override', 'output': 'bits',
+    'load_modes': {
+      'rom':       (EFUSE_ROM_FLASH_BOOT, []),
+      # Hyperflash type, and partially reconfigure pads to overcome HW issue
+      # with rwds cg latch
+      'rom_hyper': (EFUSE_ROM_FLASH_BOOT, [('or', EFUSE_INFO3, 1 << 0), ('or', EFUSE_INFO7, 1 << 2)]),
+      'rom_spim':  (EFUSE_ROM_FLASH_BOOT, []),
+    },
+    'options': [
+      # Don't use UDMA MEMCPY as it makes RTL platform crash
+      (('eq', 'vsim_model', 'rtl'), [('or', EFUSE_INFO7, 1)]),
+      (('set', ['burst_size']), [('or', EFUSE_INFO6, 1 << 7), ('set', 61, ('burst_size', 0, 0xff)), ('set', 62, ('burst_size', 8, 0xff))]),
+      (('true', 'flash_id'), [('or', EFUSE_INFO6, 1 << 5)]),
+      (('set', ['fll_freq']), [('or', EFUSE_INFO2, 1 << 0), ('set', 57, 'fll_freq')]),
+      (None, [('or', EFUSE_INFO2, 1 << 6), ('set', 35, ('ref_clk_wait', 0, 0xff)), ('set', 36, ('ref_clk_wait', 8, 0xff))]),
+      (('set', ['hyper_delay']), [('or', EFUSE_INFO5, 1 << 6), ('or', 32, 'hyper_delay')]),
+      (('set', ['hyper_latency']), [('or', EFUSE_INFO5, 1 << 7), ('or', 51, 'hyper_latency')]),
+      (('set', ['fll_lock_tolerance', 'fll_assert_cycles']), [('or', EFUSE_INFO2, 1 << 1), ('set', 58, 'fll_lock_tolerance'), ('set', 59, 'fll_assert_cycles')]),
+      EFUSE_XTAL_CHECK_V2,
+    ],
+    'encryption': [('or', EFUSE_INFO6, 1 << 4)],
+    'defaults': {'hyper_delay': 3, 'ref_clk_wait': 0},
+  },
+
+  'vega': {
+    'regs': 'array', 'user': None, 'output': 'words',
+    'load_modes': {
+      'rom':       (EFUSE_ROM_FLASH_BOOT, []),
+      # Hyperflash type
+      'rom_hyper': (EFUSE_ROM_FLASH_BOOT, [('or', EFUSE_INFO3, 1 << 0)]),
+      # SPI flash type
+      'rom_spim':  (EFUSE_ROM_FLASH_BOOT, []),
+      'rom_mram':  (EFUSE_ROM_FLASH_BOOT, EFUSE_MRAM_BOOT),
+    },
+    'options': EFUSE_VEGA_OPTIONS,
+    'encryption': [('or', EFUSE_INFO6, 1 << 4)],
+  },
+
+  'gap9_v2': {
+    'regs': 'array', 'user': None, 'output': 'words',
+    'load_modes': {
+      # Boot on UDMA SPIM1 interface (first single spi)
+      'rom':       (EFUSE_ROM_FLASH_BOOT, [('or', EFUSE_INFO5, 1 << 1)]),
+      # Hyperflash type
+      'rom_hyper': (EFUSE_ROM_FLASH_BOOT, [('or', EFUSE_INFO3, 1 << 0)]),
+      # SPI flash type, boot on UDMA SPIM1 interface (first single spi)
+      'rom_spim':  (EFUSE_ROM_FLASH_BOOT, [('or', EFUSE_INFO5, 1 << 1)]),
+      'rom_mram':  (EFUSE_ROM_FLASH_BOOT, EFUSE_MRAM_BOOT),
+    },
+    'options': EFUSE_VEGA_OPTIONS,
+    'encryption': [('or', EFUSE_INFO6, 1 << 4)],
+  },
+}
+
+EFUSE_LAYOUTS['gap9'] = EFUSE_LAYOUTS['vega']
+
+# Layout of the chips without any specific efuse, only the user values are
+# written
+EFUSE_DEFAULT_LAYOUT = {
+  'regs': 'list', 'user': 'or', 'output': 'bits', 'load_modes': {}, 'options': [], 'encryption': [],
+}
+
+# Tables extracting one bit of each byte, as 0 or 1, or the digit of a bit
+EFUSE_BIT_PLANES = [bytes([(value >> index) & 1 for value in range(0, 256)]) for index in range(0, 8)]
+EFUSE_BIT_DIGITS = bytes([ord('0') + (value & 1) for value in range(0, 256)])
+
+
+
+class EfuseEncoder(object):
+
+  # Efuse layout of a chip compiled into the list of parameters to be read
+  # from the configuration and the operations to be applied
+
+  def __init__(self, layout):
+    self.layout = layout
+    self.defaults = layout.get('defaults', {})
+
+    # Only the parameters used by the layout are read from the configuration
+    params = set()
+    if len(layout['load_modes']) != 0:
+      params.update(['load_mode', 'encrypted', 'aes_key', 'aes_iv'])
+    if layout['output'] == 'words':
+      params.add('no_preload')
+    operations = [operation for load_mode in layout['load_modes'].values() for operation in load_mode[1]]
+    for condition, option_operations in layout['options']:
+      if condition is not None:
+        params.update(condition[1] if condition[0] == 'set' else [condition[1]])
+      operations += option_operations
+    for operation in operations + layout['encryption']:
+      value = operation[-1]
+      if type(value) == tuple:
+        value = value[0]
+      if type(value) == str:
+        params.add(value)
+
+    self.params = [(name,) + EFUSE_PARAMS[name] for name in sorted(params)]
+
+  def get_params(self, config):
+    params = {}
+    for param in self.params:
+      name, path, param_type = param[0:3]
+      if param_type == 'int':
+        value = config.get_child_int(path)
+      elif param_type == 'bool':
+        value = config.get_child_bool(path)
+      else:
+        value = config.get_child_str(path)
+
+      if value is None:
+        value = self.defaults.get(name)
+      elif len(param) > 3:
+        value = int(value * param[3])
+
+      params[name] = value
+    return params
+
+  def __get_value(self, params, value):
+    if type(value) == str:
+      return params[value]
+    elif type(value) == tuple:
+      name, shift, mask = value
+      return (params[name] >> shift) & mask
+    return value
+
+  def __check(self, params, condition):
+    if condition is None:
+      return True
+    elif condition[0] == 'set':
+      for name in condition[1]:
+        if params[name] is not None:
+          return True
+      return False
+    elif condition[0] == 'true':
+      return params[condition[1]]
+    else:
+      return params[condition[1]] == condition[2]
 
-    self.__gen_stim_slm(stim_file, 8)
+  def __write(self, regs, reg, value):
+    # Registers given as a list of values are ORed together
+    if self.layout['regs'] == 'list':
+      regs[reg] = regs.get(reg, 0) | value
+    else:
+      regs[reg] = value
+
+  def __apply(self, regs, params, operations, boot):
+    for operation in operations:
+      kind = operation[0]
+      value = self.__get_value(params, operation[-1])
+      if kind == 'boot':
+        if boot is None:
+          boot = 0
+        boot |= value
+      elif kind == 'set':
+        regs[operation[1]] = value
+      elif kind == 'or':
+        regs[operation[1]] = regs.get(operation[1], 0) | value
+      else:
+        reg, shift, mask = operation[1:4]
+        regs[reg] = (regs.get(reg, 0) & ~(mask << shift)) | (value << shift)
+    return boot
+
+  def encode(self, config, user_efuses):
+
+    # Return the efuse registers as a dictionary, indexed by register
+    layout = self.layout
+    params = self.get_params(config)
+
+    if layout['regs'] == 'array':
+      regs = dict.fromkeys(range(0, 128), 0)
+    else:
+      regs = {}
 
+    boot = None
+    load_mode = layout['load_modes'].get(params.get('load_mode'))
+    if load_mode is not None:
+      boot = load_mode[0]
+      boot = self.__apply(regs, params, load_mode[1], boot)
 
-  def gen_stim_bin(self, stim_file):
+    for condition, operations in layout['options']:
+      if self.__check(params, condition):
+        boot = self.__apply(regs, params, operations, boot)
 
-    self.__parse_binaries(1)
+    # The boot mode, and the encryption which depends on it, are only written
+    # if the load mode or an option enabled the boot mode
+    if boot is not None:
+      if params['encrypted']:
+        boot |= 0x40
+        boot = self.__apply(regs, params, layout['encryption'], boot)
+        aes_key = params['aes_key']
+        aes_iv = params['aes_iv']
+        for i in range(0, 16):
+          self.__write(regs, EFUSE_AES_KEY + i, int(aes_key[30-i*2:32-i*2], 16))
+        for i in range(0, 8):
+          self.__write(regs, EFUSE_AES_IV + i, int(aes_iv[14-i*2:16-i*2], 16))
 
-    try:
-      os.makedirs(os.path.dirname(stim_file))
-    except:
-      pass
+      self.__write(regs, EFUSE_BOOT_MODE, boot)
+
+    if layout['user'] == 'or':
+      for efuse_id, value in user_efuses:
+        regs[efuse_id] = regs.get(efuse_id, 0) | value
+    elif layout['user'] == 'override':
+      for efuse_id, value in user_efuses:
+        regs[efuse_id] = value
+
+    return regs, params
+
+
+
+# Efuse encoders already compiled, indexed by chip
+efuse_encoders = {}
+
+
+def get_efuse_encoder(chip):
+  encoder = efuse_encoders.get(chip)
+  if encoder is None:
+    encoder = EfuseEncoder(EFUSE_LAYOUTS.get(chip, EFUSE_DEFAULT_LAYOUT))
+    efuse_encoders[chip] = encoder
+  return encoder
+
+
+def get_efuse_bits(regs, nb_regs):
+
+  # Return the bit file content as a buffer of 0 and 1, where bit N of
+  # register R is at index R + N*128. The bits of all registers are first
+  # gathered as one byte per register, then each bit plane is extracted at
+  # once with a translation table and ORed at its place
+  size = nb_regs * 8
+  if len(regs) == 0:
+    return bytes(size)
 
-    with open(stim_file, 'wb') as file:
-      prev_addr = None
-      for key in sorted(self.mem.keys()):
-        addr = int(key)
-        if prev_addr is not None:
-          while prev_addr != addr - 1:
-            file.write(struct.pack('B', 0))
-            prev_addr += 1
+  row = bytearray(max(regs.keys()) + 1)
+  for efuse_id, value in regs.items():
+    row[efuse_id] |= value & 0xff
 
-        prev_addr = addr
-        file.write(struct.pack('B', int(self.mem.get(key))))
+  bits = 0
+  for index in range(0, 8):
+    bits |= int.from_bytes(row.translate(EFUSE_BIT_PLANES[index]), byteorder='little') << (index * 128 * 8)
+
+  if bits.bit_length() > size * 8:
+    raise Exception('Efuse register out of range (nb_regs: %d)' % nb_regs)
+
+  return bits.to_bytes(size, byteorder='little')
 
 
 
@@ -194,434 +932,63 @@ class Efuse(object):
 
   def gen_stim_txt(self, filename):
 
-
-    user_efuses = {}
+    user_efuses = []
 
     efuses = self.config.get('**/efuse/values')
-    if efuses is None:
-      efuses = []
-    else:
-      efuses = efuses.get_dict()
-      for efuse in efuses:
+    if efuses is not None:
+      for efuse in efuses.get_dict():
         efuse_id, val = efuse.split(':')
-        efuse_id = int(efuse_id, 0)
-        val = int(val, 0)
-        user_efuses[efuse_id] = val
-
-    nb_regs = self.config.get_child_int('**/efuse/nb_regs')
+        user_efuses.append((int(efuse_id, 0), int(val, 0)))
 
     pulp_chip = self.config.get_child_str('**/chip/name')
 
     pulp_chip_family = self.config.get_child_str('**/chip/pulp_chip_family')
 
+    # Chip specific efuses are only generated for the GAP family
     if pulp_chip_family == 'gap' or pulp_chip == 'vega' or pulp_chip == 'gap9' or pulp_chip == 'gap9_v2':
+      encoder = get_efuse_encoder(pulp_chip)
+    else:
+      encoder = get_efuse_encoder(None)
 
-      load_mode = self.config.get_child_str('**/runner/boot-mode')
-      encrypted = self.config.get_child_str('**/efuse/encrypted')
-      aes_key = self.config.get_child_str('**/efuse/aes_key')
-      aes_iv = self.config.get_child_str('**/efuse/aes_iv')
-      xtal_check = self.config.get_child_bool('**/efuse/xtal_check')
-      xtal_check_delta = self.config.get_child_bool('**/efuse/xtal_check_delta')
-      xtal_check_min = self.config.get_child_bool('**/efuse/xtal_check_min')
-      xtal_check_max = self.config.get_child_bool('**/efuse/xtal_check_max')
-      no_preload = self.config.get_child_str('**/efuse/no-preload')
-
-      # In case we boot with the classic rom mode, don't init any efuse, the boot loader will boot with the default mode
-      load_mode_hex = None
-
-      if pulp_chip == 'gap':
-
-        if load_mode == 'rom':
-          load_mode_hex = 0x3A
-        elif load_mode == 'spi':
-          load_mode_hex = 0x0A
-        elif load_mode == 'jtag':
-          load_mode_hex = 0x12
-        elif load_mode == 'rom_hyper':
-          load_mode_hex = 0x2A
-        elif load_mode == 'rom_spim_single':
-          load_mode_hex = 0x32
-        elif load_mode == 'rom_spim':
-          load_mode_hex = 0x3A
-        elif load_mode == 'jtag_dev' or load_mode == 'spi_dev':
-          load_mode_hex = None
-
-        if xtal_check:
-            if load_mode_hex == None: load_mode_hex = 0
-            load_mode_hex |= 1<<7
-            delta = int(xtal_check_delta*((1 << 15)-1))
-            efuses.append('26:0x%x' % (delta & 0xff))
-            efuses.append('27:0x%x' % ((delta >> 8) & 0xff))
-            efuses.append('28:0x%x' % (xtal_check_min))
-            efuses.append('29:0x%x' % (xtal_check_max))
-
-        if load_mode_hex != None:
-            if encrypted: 
-                load_mode_hex |= 0x40
-                for i in range(0, 16):
-                    efuses.append('%d:0x%s' % (2+i, aes_key[30-i*2:32-i*2]))
-                for i in range(0, 8):
-                    efuses.append('%d:0x%s' % (18+i, aes_iv[14-i*2:16-i*2]))
-
-            efuses.append('0:%s' % load_mode_hex)
-    
-      elif pulp_chip == 'vega' or pulp_chip == 'gap9':
-        efuses = [0] * 128
-        info2 = 0
-        info3 = 0
-        info4 = 0
-        info5 = 0
-        info6 = 0
-
-        clk_div = self.config.get_child_int('**/efuse/clkdiv')
-        fll_freq = self.config.get_child_int('**/efuse/fll/freq')
-        fll_assert_cycles = self.config.get_child_int('**/efuse/fll/assert_cycles')
-        fll_lock_tolerance = self.config.get_child_int('**/efuse/fll/lock_tolerance')
-        hyper_delay = self.config.get_child_int('**/efuse/hyper/delay')
-        hyper_latency = self.config.get_child_int('**/efuse/hyper/latency')
-
-        if load_mode == 'rom':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-        elif load_mode == 'rom_hyper':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          # Hyperflash type
-          info3 = (1 << 0)
-        elif load_mode == 'rom_spim':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          # SPI flash type
-          info3 = (0 << 0)
-        elif load_mode == 'rom_mram':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          # MRAM type
-          info3 = (2 << 0)
-          # Activate MRAM TRIM CFG and fill it with dummy numbers until we get the real one. Also activate clock divider
-          info6 |= (1 << 6) | (1<<7)
-          info2 |= (2 << 3)
-          efuses[56] = 32*4
-          for i in range(0, 32):
-            efuses [57+i] = i | ((i*4+1)<<8) | ((i*4+2)<<16) | ((i*4+3)<<24)
-        
-        if clk_div is not None:
-          info6 |= 1 << 7
-          info2 = (info2 & ~(3<<3)) | (clk_div << 3)
-
-
-        if fll_freq is not None:
-          info2 |= (1 << 0) | (1 << 2)
-          efuses[31] = fll_freq
-
-        if fll_lock_tolerance is not None or fll_assert_cycles is not None:
-          info2 |= (1<< 1)
-          efuses[32] = fll_lock_tolerance
-          efuses[33] = fll_assert_cycles
-
-        if hyper_delay is not None:
-          info5 |= (1<<6)
-          efuses[30] = hyper_delay
-
-        if hyper_latency is not None:
-          info5 |= (1<<7)
-          efuses[51] = hyper_latency
-
-
-
-        if load_mode_hex != None:
-            if encrypted: 
-                load_mode_hex |= 0x40
-                info6 |= 1<<4
-                for i in range(0, 16):
-                    efuses[2+i] = aes_key[30-i*2:32-i*2]
-                for i in range(0, 8):
-                    efuses[18+i] = aes_iv[14-i*2:16-i*2]
-
-            efuses[0] = load_mode_hex
-    
-        efuses[1] = info2
-        efuses[37] = info3
-        efuses[38] = info4
-        efuses[39] = info5 
-        efuses[40] = info6
-
-      elif pulp_chip == 'gap9_v2':
-
-        efuses = [0] * 128
-        info2 = 0
-        info3 = 0
-        info4 = 0
-        info5 = 0
-        info6 = 0
-
-        clk_div = self.config.get_child_int('**/efuse/clkdiv')
-        fll_freq = self.config.get_child_int('**/efuse/fll/freq')
-        fll_assert_cycles = self.config.get_child_int('**/efuse/fll/assert_cycles')
-        fll_lock_tolerance = self.config.get_child_int('**/efuse/fll/lock_tolerance')
-        hyper_delay = self.config.get_child_int('**/efuse/hyper/delay')
-        hyper_latency = self.config.get_child_int('**/efuse/hyper/latency')
-
-        if load_mode == 'rom':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          info5 |= 1 << 1   # Boot on UDMA SPIM1 interface (first single spi)
-        elif load_mode == 'rom_hyper':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          # Hyperflash type
-          info3 = (1 << 0)
-        elif load_mode == 'rom_spim':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          # SPI flash type
-          info3 = (0 << 0)
-          info5 |= 1 << 1   # Boot on UDMA SPIM1 interface (first single spi)
-        elif load_mode == 'rom_mram':
-          # RTL platform | flash boot | no encryption | no wait xtal
-          load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          # MRAM type
-          info3 = (2 << 0)
-          # Activate MRAM TRIM CFG and fill it with dummy numbers until we get the real one. Also activate clock divider
-          info6 |= (1 << 6) | (1<<7)
-          info2 |= (2 << 3)
-          efuses[56] = 32*4
-          for i in range(0, 32):
-            efuses [57+i] = i | ((i*4+1)<<8) | ((i*4+2)<<16) | ((i*4+3)<<24)
-        
-        if clk_div is not None:
-          info6 |= 1 << 7
-          info2 = (info2 & ~(3<<3)) | (clk_div << 3)
-
-
-        if fll_freq is not None:
-          info2 |= (1 << 0) | (1 << 2)
-          efuses[31] = fll_freq
-
-        if fll_lock_tolerance is not None or fll_assert_cycles is not None:
-          info2 |= (1<< 1)
-          efuses[32] = fll_lock_tolerance
-          efuses[33] = fll_assert_cycles
-
-        if hyper_delay is not None:
-          info5 |= (1<<6)
-          efuses[30] = hyper_delay
-
-        if hyper_latency is not None:
-          info5 |= (1<<7)
-          efuses[51] = hyper_latency
-
-
-
-        if load_mode_hex != None:
-            if encrypted: 
-                load_mode_hex |= 0x40
-                info6 |= 1<<4
-                for i in range(0, 16):
-                    efuses[2+i] = aes_key[30-i*2:32-i*2]
-                for i in range(0, 8):
-                    efuses[18+i] = aes_iv[14-i*2:16-i*2]
-
-            efuses[0] = load_mode_hex
-    
-        efuses[1] = info2
-        efuses[37] = info3
-        efuses[38] = info4
-        efuses[39] = info5 
-        efuses[40] = info6
-
-      elif pulp_chip == 'gap_rev1':
-          info3 = 0
-          info6 = 0
-          if load_mode == 'rom':
-            # RTL platform | flash boot | no encryption | no wait xtal
-            load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          elif load_mode == 'rom_hyper':
-            # RTL platform | flash boot | no encryption | no wait xtal
-            load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-            # Hyperflash type
-            info3 = (1 << 0)
-          elif load_mode == 'rom_spim':
-            # RTL platform | flash boot | no encryption | no wait xtal
-            load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-            # SPI flash type
-            info3 = (0 << 0)
-          
-          if xtal_check:
-              if load_mode_hex == None: load_mode_hex = 0
-              load_mode_hex |= 1<<7
-              delta = int(xtal_check_delta*((1 << 15)-1))
-              efuses.append('26:0x%x' % (delta & 0xff))
-              efuses.append('27:0x%x' % ((delta >> 8) & 0xff))
-              efuses.append('28:0x%x' % (xtal_check_min))
-              efuses.append('29:0x%x' % (xtal_check_max))
-
-          if load_mode_hex != None:
-              if encrypted: 
-                  load_mode_hex |= 0x40
-                  info6 |= 1<<4
-                  for i in range(0, 16):
-                      efuses.append('%d:0x%s' % (2+i, aes_key[30-i*2:32-i*2]))
-                  for i in range(0, 8):
-                      efuses.append('%d:0x%s' % (18+i, aes_iv[14-i*2:16-i*2]))
-
-              efuses.append('0:%s' % load_mode_hex)
-      
-          efuses.append('1:%s' % 0)
-          efuses.append('37:%s' % (info3))
-          efuses.append('38:%s' % 0)
-          efuses.append('39:%s' % 0)        
-          efuses.append('40:%s' % (info6))
-                  
-      elif pulp_chip == 'gap8_revc':
-
-          fll_freq = self.config.get_child_int('**/efuse/fll/freq')
-          ref_clk_wait = self.config.get_child_int('**/efuse/ref_clk_wait')
-          burst_size = self.config.get_child_int('**/efuse/burst_size')
-          flash_id = self.config.get_child_bool('**/efuse/flash_id')
-          fll_assert_cycles = self.config.get_child_int('**/efuse/fll/assert_cycles')
-          fll_lock_tolerance = self.config.get_child_int('**/efuse/fll/lock_tolerance')
-          hyper_delay = self.config.get_child_int('**/efuse/hyper/delay')
-          hyper_latency = self.config.get_child_int('**/efuse/hyper/latency')
-
-          if hyper_delay is None:
-            hyper_delay = 3
-
-          efuses = [0] * 128
-          info3 = 0
-          info2 = 0
-          info6 = 0
-          info5 = 0
-
-          if self.config.get_child_str('**/vsim/model') == 'rtl':
-            info7 = 1 # Don't use UDMA MEMCPY as it makes RTL platform crash
-          else:
-            info7 = 0
-          if load_mode == 'rom':
-            # RTL platform | flash boot | no encryption | no wait xtal
-            load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-          elif load_mode == 'rom_hyper':
-            # RTL platform | flash boot | no encryption | no wait xtal
-            load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-            # Hyperflash type
-            info3 = (1 << 0)
-            info7 |= (1 << 2) # Partially reconfigure pads to overcome HW issue with rwds cg latch
-          elif load_mode == 'rom_spim':
-            # RTL platform | flash boot | no encryption | no wait xtal
-            load_mode_hex = 2 | (2 << 3) | (0 << 4) | (0 << 5) | (0 << 6) | (0 << 7)
-            # SPI flash type
-            info3 = (0 << 0)
-          
-          if burst_size is not None:
-            info6 |= (1 << 7)
-            efuses[61] = burst_size & 0xff
-            efuses[62] = (burst_size >> 8) & 0xff
-
-          if flash_id:
-            info6 |= (1 << 5)
-
-          if fll_freq is not None:
-            info2 |= (1 << 0)
-            efuses[57] = fll_freq
-
-          if ref_clk_wait is not None:
-            info2 |= (1 << 6)
-            efuses[35] = ref_clk_wait & 0xff
-            efuses[36] = (ref_clk_wait >> 8) & 0xff
-          else:
-            info2 |= (1 << 6)
-            efuses[35] = 0
-            efuses[36] = 0
-
-          if hyper_delay is not None:
-            info5 |= (1<<6)
-            efuses[32] |= hyper_delay
-
-          if hyper_latency is not None:
-            info5 |= (1<<7)
-            efuses[51] |= hyper_latency
-
-
-          if fll_lock_tolerance is not None or fll_assert_cycles is not None:
-            info2 |= (1<< 1)
-            efuses[58] = fll_lock_tolerance
-            efuses[59] = fll_assert_cycles
-
-          if xtal_check:
-              if load_mode_hex == None: load_mode_hex = 0
-              load_mode_hex |= 1<<7
-              delta = int(xtal_check_delta*((1 << 15)-1))
-              efuses[26] = delta & 0xff
-              efuses[27] = (delta >> 8) & 0xff
-              efuses[28] = xtal_check_min & 0xff
-              efuses[29] = (xtal_check_min >> 8) & 0xff
-              efuses[30] |= xtal_check_max & 0xff
-              efuses[31] = (xtal_check_max >> 8) & 0xff
-
-          if load_mode_hex != None:
-              if encrypted: 
-                  load_mode_hex |= 0x40
-                  info6 |= 1<<4
-                  for i in range(0, 16):
-                      efuses[2+i] = int('0x%s' % aes_key[30-i*2:32-i*2], 0)
-                  for i in range(0, 8):
-                      efuses[18+i] = int('0x%s' % aes_iv[14-i*2:16-i*2], 0)
-
-              efuses[0] = load_mode_hex
-      
-          efuses[1] = info2
-          efuses[37] = info3
-          efuses[38] = 0
-          efuses[39] = info5    
-          efuses[40] = info6
-          efuses[60] = info7
-                  
+    regs, params = encoder.encode(self.config, user_efuses)
 
     # Efuse preloading file generation
-    if pulp_chip == 'vega' or pulp_chip == 'gap9' or pulp_chip == 'gap9_v2':
+    if encoder.layout['output'] == 'words':
 
       self.dump('  Generating to file: ' + filename)
 
       with open(filename, 'w') as file:
+        no_preload = params.get('no_preload')
         if no_preload is None or no_preload == False:
-          for efuseId in range (0, 128):
-              value = efuses[efuseId]
-              self.dump('  Writing register (index: %d, value: 0x%x)' % (efuseId, value))
-              file.write('{0:032b}\n'.format(value))
-  
-    elif pulp_chip == 'gap8_revc':
-
-      values = [0] * nb_regs * 8
-      for efuseId in range (0, nb_regs):
-        value = user_efuses.get(efuseId)
-        if value is None:
-          value = efuses[efuseId]
-        self.dump('  Writing register (index: %d, value: 0x%x)' % (efuseId, value))
-        for index in range(0, 8):
-            if (value >> index) & 1 == 1: values[efuseId + index*128] = 1
+          if self.verbose:
+            for efuseId in range (0, 128):
+              self.dump('  Writing register (index: %d, value: 0x%x)' % (efuseId, regs[efuseId]))
+          file.write(''.join(['{0:032b}\n'.format(regs[efuseId]) for efuseId in range(0, 128)]))
 
-      self.dump('  Generating to file: ' + filename)
+    else:
 
-      with open(filename, 'w') as file:
-          for value in values:
-              file.write('%d ' % (value))
+      nb_regs = self.config.get_child_int('**/efuse/nb_regs')
 
-    else:
+      if encoder.layout['regs'] == 'array':
+        # All the registers are written, but only up to the number of
+        # registers of the chip
+        regs = dict([(efuseId, regs[efuseId]) for efuseId in range(0, nb_regs)])
+
+      if self.verbose:
+        for efuseId in sorted(regs.keys()):
+          self.dump('  Writing register (index: %d, value: 0x%x)' % (efuseId, regs[efuseId]))
 
-      values = [0] * nb_regs * 8
-      for efuse in efuses:
-          efuseId, value = efuse.split(':')
-          self.dump('  Writing register (index: %d, value: 0x%x)' % (int(efuseId, 0), int(value, 0)))
-          efuseId = int(efuseId, 0)
-          value = int(value, 0)
-          for index in range(0, 8):
-              if (value >> index) & 1 == 1: values[efuseId + index*128] = 1
+      bits = get_efuse_bits(regs, nb_regs)
 
       self.dump('  Generating to file: ' + filename)
 
+      # Each bit is written as a digit followed by a space
+      text = bytearray(len(bits) * 2)
+      text[0::2] = bits.translate(EFUSE_BIT_DIGITS)
+      text[1::2] = b' ' * len(bits)
+
       with open(filename, 'w') as file:
-          for value in values:
-              file.write('%d ' % (value))
+        file.write(text.decode())
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Generate stimuli')
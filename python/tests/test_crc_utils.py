@@ -0,0 +1,74 @@
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import runner.crc_utils as crc_utils
+
+
+# Bit by bit CRC previously computed by the image builders, which the boot
+# ROMs are checked against
+def get_crc_ref(buff):
+  crc = 0xffffffff
+  for data in buff:
+    crc = crc ^ data
+    for i in range(7, -1, -1):
+      if crc & 1 == 1:
+        mask = 0xffffffff
+      else:
+        mask = 0
+      crc = (crc >> 1) ^ (0xEDB88320 & mask)
+
+  return (crc ^ 0xffffffff)
+
+
+def get_buffers(seed, nb_buffers=200, max_size=600):
+  rand = random.Random(seed)
+  buffers = [b'', b'\x00', b'\xff', bytes(64), b'\xff' * 64]
+  for i in range(0, nb_buffers):
+    buffers.append(bytes([rand.randrange(256) for j in range(0, rand.randrange(max_size))]))
+  return rand, buffers
+
+
+def test_crc_matches_reference():
+  rand, buffers = get_buffers(0)
+  for buff in buffers:
+    assert crc_utils.get_crc(buff) == get_crc_ref(buff)
+
+
+def test_crc_accepts_buffer_types():
+  rand, buffers = get_buffers(1, nb_buffers=20)
+  for buff in buffers:
+    crc = get_crc_ref(buff)
+    assert crc_utils.get_crc(bytearray(buff)) == crc
+    assert crc_utils.get_crc(memoryview(bytearray(buff))) == crc
+
+
+def test_crc_incremental():
+  rand, buffers = get_buffers(2)
+  for buff in buffers:
+    # Split the buffer at random points and chain the CRC through the parts
+    cuts = sorted([rand.randrange(len(buff) + 1) for i in range(0, rand.randrange(4))])
+    crc = 0
+    start = 0
+    for end in cuts + [len(buff)]:
+      crc = crc_utils.get_crc(buff[start:end], crc)
+      start = end
+    assert crc == get_crc_ref(buff)
@@ -0,0 +1,126 @@
+#
+# Copyright (C) 2018 ETH Zurich, University of Bologna and GreenWaves Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import runner.plp_flash_stimuli as plp_flash_stimuli
+import runner.plp_flash_stimuli_vivo3 as plp_flash_stimuli_vivo3
+
+
+AES_KEY = '0123456789abcdef0123456789abcdef'
+AES_IV = '0011223344556677'
+
+
+def get_binary(module, rand):
+    # Boot binary with a few L2 segments and sometimes an L1 one
+    binary = module.Binary()
+    binary.entry = 0x1c008080
+    base = 0x1c000000 + rand.randrange(0, 0x100) * 4
+    for i in range(0, rand.randint(1, 4)):
+        data = bytes([rand.randrange(256) for j in range(0, rand.randint(1, 9000))])
+        binary.segments.append(module.BinarySegment(base, data))
+        base += len(data) + rand.randrange(0, 64)
+    if rand.random() < 0.5:
+        data = bytes([rand.randrange(256) for j in range(0, rand.randint(1, 3000))])
+        binary.segments.append(module.BinarySegment(0x10000000 + rand.randrange(0, 64), data))
+    return binary
+
+
+def get_comps(path, rand):
+    # Components with some identical contents, and some different contents
+    # of the same size
+    contents = [bytes([rand.randrange(256) for j in range(0, size)]) for size in [0, 100, 100, 2000, 5001]]
+    comps = []
+    for index in range(0, rand.randint(0, 6)):
+        name = 'comp%d.bin' % index
+        with open(os.path.join(path, name), 'wb') as file:
+            file.write(rand.choice(contents))
+        comps.append(name)
+    return comps
+
+
+def get_layout(layout):
+    return (
+        layout.blockSize,
+        [(area.offset, area.base, area.size, area.nbBlocks) for area in layout.bootAreas],
+        layout.fsOffset, layout.compsOffset,
+        [(comp.name, comp.flashAddr, comp.size) for comp in layout.comps],
+        layout.size
+    )
+
+
+def check_plan(tmp_path, module, seed, raw_fs=False, **kwargs):
+    rand = random.Random(seed)
+    path = str(tmp_path)
+    extra = {}
+    if raw_fs:
+        extra['raw_fs'] = os.path.join(path, 'fs.raw')
+        with open(extra['raw_fs'], 'wb') as file:
+            file.write(bytes(rand.randint(0, 30000)))
+
+    # On vivosoc3, the raw file contains the boot binary sections instead of
+    # the image, and a boot binary is needed
+    sections = kwargs.get('archi') in ['vivosoc3', 'vivosoc3_1']
+
+    for trial in range(0, 4):
+        image = module.FlashImage(raw=os.path.join(path, 'flash.bin'), verbose=False, aesKey=AES_KEY, aesIv=AES_IV, **kwargs, **extra)
+        if trial != 0 or sections:
+            image.bootBinary = get_binary(module, rand)
+        for comp in get_comps(path, rand):
+            image.appendComponent(path, comp)
+
+        # The plan must be computed before the image is generated, as the
+        # generation modifies the segments
+        plan = image.plan()
+        image.generate()
+
+        assert get_layout(plan) == get_layout(image.get_info())
+        if not sections:
+            assert plan.size == os.path.getsize(os.path.join(path, 'flash.bin'))
+
+
+@pytest.mark.parametrize('archi', [None, 'vivosoc2', 'fulmine'])
+@pytest.mark.parametrize('flashType', ['spi', 'hyper', 'mram'])
+@pytest.mark.parametrize('encrypt', [False, True])
+@pytest.mark.parametrize('dedup', [False, True])
+def test_plan_matches_image(tmp_path, archi, flashType, encrypt, dedup):
+    check_plan(tmp_path, plp_flash_stimuli, 0, archi=archi, flashType=flashType, encrypt=encrypt, dedup=dedup)
+
+
+@pytest.mark.parametrize('archi', [None, 'vivosoc2'])
+@pytest.mark.parametrize('encrypt', [False, True])
+def test_plan_matches_image_raw_fs(tmp_path, archi, encrypt):
+    check_plan(tmp_path, plp_flash_stimuli, 1, raw_fs=True, archi=archi, encrypt=encrypt)
+
+
+@pytest.mark.parametrize('archi', ['vivosoc3', 'vivosoc3_1', 'vivosoc2'])
+@pytest.mark.parametrize('flashType', ['spi', 'hyper', 'mram'])
+@pytest.mark.parametrize('encrypt', [False, True])
+@pytest.mark.parametrize('dedup', [False, True])
+def test_plan_matches_image_vivo3(tmp_path, archi, flashType, encrypt, dedup):
+    check_plan(tmp_path, plp_flash_stimuli_vivo3, 2, archi=archi, flashType=flashType, encrypt=encrypt, dedup=dedup)
+
+
+def test_plan_rejects_nand(tmp_path):
+    image = plp_flash_stimuli_vivo3.FlashImage(raw=os.path.join(str(tmp_path), 'flash.bin'), verbose=False, archi='vivosoc3', flashType='nand')
+    with pytest.raises(Exception):
+        image.plan()